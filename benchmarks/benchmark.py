@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements. See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership. The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License. You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+import argparse
+import sys
+import os
+import json
+import time
+import random
+import re
+import shutil
+import socket
+import tempfile
+import threading
+import platform
+import datetime
+import multiprocessing
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from filecollector import collector
+
+STAGES = ["discovery", "copy", "rules", "compression", "fluent", "collector"]
+RULES = [
+    {"pattern": r"\d{4}[^\w]\d{4}[^\w]\d{4}[^\w]\d{4}", "replacement": "[REDACTED]"},
+    {"pattern": r"\b\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}\b", "replacement": "[IP]"}
+]
+LEVELS = ["INFO", "INFO", "INFO", "DEBUG", "WARN", "ERROR"]
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(
+        description='Benchmark for the filecollector collector (with a synthetic log corpus)')
+    parser.add_argument('--work-dir', type=str, required=False, dest="work_dir",
+                        help='Folder for the generated corpus and the outputs (default: temporary folder, removed at the end)')
+    parser.add_argument('--labels', type=int, default=2,
+                        help='Number of labels (folders) in the corpus')
+    parser.add_argument('--files', type=int, default=20,
+                        help='Number of log files per label')
+    parser.add_argument('--file-size', type=int, default=1048576, dest="file_size",
+                        help='Size of one log file in bytes')
+    parser.add_argument('--line-length', type=int, default=120, dest="line_length",
+                        help='Average line length in bytes')
+    parser.add_argument('--rotations', type=int, default=0,
+                        help='Number of rotated files (app.log.1, app.log.2 ...) per log file')
+    parser.add_argument('--stages', type=str, default=",".join(STAGES),
+                        help='Comma separated list of stages to run: %s' % ", ".join(STAGES))
+    parser.add_argument('--collector-config', type=str, required=False, dest="collector_config",
+                        help='YAML file with collector options that are used for the end to end run (files and outputLocation are generated)')
+    parser.add_argument('--seed', type=int, default=42,
+                        help='Random seed for the corpus generator')
+    parser.add_argument('--output', type=str, required=False,
+                        help='Write the results into this JSON file')
+    parser.add_argument('--compare', type=str, required=False,
+                        help='Compare the results with an earlier JSON result file')
+    parser.add_argument('--max-regression', type=float, default=0.2, dest="max_regression",
+                        help='Allowed slowdown ratio (compared to the --compare results) before the benchmark fails')
+    args = parser.parse_args(args)
+    return args
+
+def main(args):
+    args = parse_args(args)
+    stages = [stage for stage in args.stages.split(",") if stage]
+    for stage in stages:
+        if stage not in STAGES:
+            raise ValueError("unknown stage: %s" % stage)
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="filecollector-benchmark-")
+    try:
+        corpus_dir = os.path.join(work_dir, "corpus")
+        if os.path.exists(corpus_dir):
+            shutil.rmtree(corpus_dir)
+        start = time.time()
+        corpus = generate_corpus(corpus_dir, args.labels, args.files, args.file_size, args.line_length, args.rotations, args.seed)
+        print("generated %d file(s), %d bytes in %.2fs" % (corpus["files"], corpus["bytes"], time.time() - start))
+        collector_config = {}
+        if args.collector_config:
+            with open(args.collector_config) as file:
+                collector_config = yaml.load(file, yaml.SafeLoader) or {}
+        results = {
+            "time": datetime.datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": multiprocessing.cpu_count(),
+            "corpus": corpus,
+            "stages": {}
+        }
+        for stage in stages:
+            output_dir = os.path.join(work_dir, "output-%s" % stage)
+            if os.path.exists(output_dir):
+                shutil.rmtree(output_dir)
+            os.makedirs(output_dir)
+            result = run_stage(stage, corpus, output_dir, collector_config)
+            shutil.rmtree(output_dir)
+            results["stages"][stage] = result
+            print("%-12s %8.3fs %10.2f MB/s %10.2f files/s  peak RSS: %8.1f MB  disk amplification: %.2f" % (
+                stage, result["seconds"], result["mb_per_second"], result["files_per_second"],
+                result["peak_rss_bytes"] / 1048576.0, result["disk_amplification"]))
+            if "speedup" in result:
+                print("%-12s %8.3fs %10.2f MB/s (line by line re.sub reference, speedup: %.2fx)" % (
+                    "", result["reference_seconds"], corpus["bytes"] / 1048576.0 / result["reference_seconds"], result["speedup"]))
+        if args.output:
+            with open(args.output, "w") as file:
+                json.dump(results, file, indent=2)
+        regressions = [stage for stage, result in results["stages"].items() if result.get("speedup", 1.0) < 1 - args.max_regression]
+        if args.compare:
+            with open(args.compare) as file:
+                regressions += compare_results(json.load(file), results, args.max_regression)
+        if regressions:
+            print("regression in stage(s): %s" % ", ".join(regressions))
+            sys.exit(1)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir)
+
+def generate_corpus(root, labels, files, file_size, line_length, rotations, seed):
+    """
+    Generate log files with timestamps, log levels and some sensitive data (card numbers, IPs) for the rules.
+    Layout: <root>/label-<n>/app-<n>.log (+ app-<n>.log.<rotation> files).
+    """
+    random.seed(seed)
+    result = {"root": root, "labels": [], "files": 0, "bytes": 0, "lines": 0}
+    timestamp = time.time() - 86400
+    for labelIndex in range(labels):
+        label = "label-%d" % labelIndex
+        label_dir = os.path.join(root, label)
+        os.makedirs(label_dir)
+        result["labels"].append({"label": label, "path": os.path.join(label_dir, "app-*.log*")})
+        for fileIndex in range(files):
+            for rotation in range(rotations, -1, -1):
+                name = "app-%d.log" % fileIndex + (".%d" % rotation if rotation else "")
+                size, lines = __write_log_file(os.path.join(label_dir, name), file_size, line_length, timestamp)
+                timestamp += 1
+                result["files"] += 1
+                result["bytes"] += size
+                result["lines"] += lines
+    return result
+
+def __write_log_file(path, file_size, line_length, timestamp):
+    size = 0
+    lines = 0
+    buffer = []
+    with open(path, "w") as file:
+        while size < file_size:
+            prefix = "%s %-5s [thread-%d] " % (datetime.datetime.fromtimestamp(timestamp + lines * 0.001).strftime("%Y-%m-%d %H:%M:%S,%f")[:-3],
+                                                random.choice(LEVELS), random.randint(1, 16))
+            kind = random.random()
+            if kind < 0.05:
+                message = "payment with card %04d-%04d-%04d-%04d" % tuple(random.randint(0, 9999) for i in range(4))
+            elif kind < 0.1:
+                message = "request from %d.%d.%d.%d" % tuple(random.randint(1, 254) for i in range(4))
+            else:
+                message = "message"
+            padding = max(0, int(random.gauss(line_length, line_length / 4.0)) - len(prefix) - len(message) - 2)
+            line = "%s%s %s\n" % (prefix, message, "x" * padding)
+            buffer.append(line)
+            size += len(line)
+            lines += 1
+            if len(buffer) >= 1000:
+                file.write("".join(buffer))
+                buffer = []
+        file.write("".join(buffer))
+    return size, lines
+
+def run_stage(stage, corpus, output_dir, collector_config):
+    """
+    Run one stage in a separate process, so the peak RSS belongs to that stage only.
+    """
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=__run_stage_in_process, args=(stage, corpus, output_dir, collector_config, results))
+    process.start()
+    result = results.get()
+    process.join()
+    if "error" in result:
+        raise RuntimeError("stage '%s' failed: %s" % (stage, result["error"]))
+    return result
+
+def __run_stage_in_process(stage, corpus, output_dir, collector_config, results):
+    try:
+        import resource
+        sampler = DiskSampler(output_dir)
+        sampler.start()
+        start = time.time()
+        extra = STAGE_FUNCTIONS[stage](corpus, output_dir, collector_config) or {}
+        # a stage can time its measured part itself (e.g. without a reference run)
+        seconds = max(extra.pop("seconds", time.time() - start), 1e-9)
+        sampler.stop()
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if platform.system() != "Darwin":
+            peak_rss = peak_rss * 1024
+        result = {
+            "seconds": seconds,
+            "mb_per_second": corpus["bytes"] / 1048576.0 / seconds,
+            "files_per_second": corpus["files"] / seconds,
+            "peak_rss_bytes": peak_rss,
+            "peak_disk_bytes": sampler.peak,
+            "disk_amplification": sampler.peak / float(corpus["bytes"]) if corpus["bytes"] else 0.0
+        }
+        result.update(extra)
+        results.put(result)
+    except Exception as error:
+        results.put({"error": "%s: %s" % (type(error).__name__, error)})
+
+def __corpus_files(corpus):
+    index = collector.FileIndex()
+    return [(label["label"], file, index.stat(file)) for label in corpus["labels"] for file in index.glob(label["path"])]
+
+def __stage_discovery(corpus, output_dir, collector_config):
+    return {"matched_files": len(__corpus_files(corpus))}
+
+def __stage_copy(corpus, output_dir, collector_config):
+    methods = {}
+    for label, file, stat in __corpus_files(corpus):
+        method = collector.copy_file(file, os.path.join(output_dir, "%s-%s" % (label, os.path.basename(file))), stat)
+        methods[method] = methods.get(method, 0) + 1
+    return {"copy_methods": methods}
+
+def __stage_rules(corpus, output_dir, collector_config):
+    """
+    Anonymize the corpus with the rule engine, then with a plain line by line re.sub loop (the reference), and check
+    that both produce the same output. The reference is not part of the stage time.
+    """
+    rules = collector_config.get("rules") or RULES
+    ruleEngine = collector.RuleEngine(rules)
+    files = __corpus_files(corpus)
+    start = time.time()
+    for label, file, stat in files:
+        ruleEngine.anonymize(file, os.path.join(output_dir, "%s-%s" % (label, os.path.basename(file))))
+    seconds = max(time.time() - start, 1e-9)
+    patterns = [(re.compile(rule["pattern"]), rule["replacement"]) for rule in rules]
+    # outside of the output folder, so it does not count into the disk amplification
+    descriptor, reference = tempfile.mkstemp(suffix=".log")
+    os.close(descriptor)
+    start = time.time()
+    try:
+        for label, file, stat in files:
+            with open(file, newline="", errors="surrogateescape") as infile, open(reference, "w", newline="", errors="surrogateescape") as outfile:
+                for line in infile:
+                    ending = "\r\n" if line.endswith("\r\n") else "\n" if line.endswith("\n") else ""
+                    line = line[:len(line) - len(ending)]
+                    for pattern, replacement in patterns:
+                        line = pattern.sub(replacement, line)
+                    outfile.write(line + ending)
+            with open(reference, "rb") as expected, open(os.path.join(output_dir, "%s-%s" % (label, os.path.basename(file))), "rb") as actual:
+                if expected.read() != actual.read():
+                    raise ValueError("the rule engine output of '%s' differs from the line by line reference" % file)
+        reference_seconds = max(time.time() - start, 1e-9)
+    finally:
+        os.remove(reference)
+    return {"seconds": seconds, "reference_seconds": reference_seconds, "speedup": reference_seconds / seconds}
+
+def __stage_compression(corpus, output_dir, collector_config):
+    compressFormat = collector_config.get("compressFormat", "zip")
+    extension = collector.ARCHIVE_EXTENSIONS[compressFormat]
+    destination = os.path.join(output_dir, "corpus")
+    collector.make_archive(corpus["root"], destination, compressFormat, extension,
+                           collector_config.get("compressLevel"), collector_config.get("compressThreads", 1))
+    return {"archive_bytes": os.path.getsize("%s.%s" % (destination, extension))}
+
+def __stage_fluent(corpus, output_dir, collector_config):
+    stub = FluentStub()
+    fluentConfig = collector_config.get("fluentProcessor") or {}
+    processor = collector.EventProcessor("127.0.0.1", stub.port, "benchmark", None,
+                                         batch_size=fluentConfig.get("batchSize", 1000))
+    for label, file, stat in __corpus_files(corpus):
+        processor.process(label, file, file)
+    failed = processor.close()
+    stub.stop()
+    return {"bytes_received": stub.received, "failed_events": failed or 0}
+
+def __stage_collector(corpus, output_dir, collector_config):
+    config = {"collector": dict(collector_config)}
+    config["collector"]["files"] = [{"path": label["path"], "label": label["label"]} for label in corpus["labels"]]
+    config["collector"]["outputLocation"] = output_dir
+    config["collector"].setdefault("rules", RULES)
+    config["collector"].pop("fluentProcessor", None)
+    config_file = os.path.join(output_dir, "filecollector.yaml")
+    with open(config_file, "w") as file:
+        yaml.dump(config, file)
+    collector.main(["--config", config_file])
+
+STAGE_FUNCTIONS = {
+    "discovery": __stage_discovery,
+    "copy": __stage_copy,
+    "rules": __stage_rules,
+    "compression": __stage_compression,
+    "fluent": __stage_fluent,
+    "collector": __stage_collector
+}
+
+def compare_results(baseline, results, max_regression):
+    regressions = []
+    for stage, result in results["stages"].items():
+        if stage not in baseline.get("stages", {}):
+            continue
+        ratio = result["seconds"] / max(baseline["stages"][stage]["seconds"], 1e-9)
+        print("%-12s %8.3fs -> %8.3fs (%+.1f%%)" % (stage, baseline["stages"][stage]["seconds"], result["seconds"], (ratio - 1) * 100))
+        if ratio > 1 + max_regression:
+            regressions.append(stage)
+    return regressions
+
+class DiskSampler:
+    """
+    Samples the size of a folder from a background thread and keeps the peak value.
+    """
+
+    def __init__(self, folder, interval=0.05):
+        self.folder = folder
+        self.interval = interval
+        self.peak = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.__run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.__sample()
+
+    def __run(self):
+        while not self.stopped.wait(self.interval):
+            self.__sample()
+
+    def __sample(self):
+        size = 0
+        for root, dirs, files in os.walk(self.folder):
+            for file in files:
+                try:
+                    size += os.lstat(os.path.join(root, file)).st_blocks * 512
+                except (OSError, AttributeError):
+                    pass
+        self.peak = max(self.peak, size)
+
+class FluentStub:
+    """
+    Forward protocol stand-in on localhost: accepts one connection and counts the received bytes.
+    """
+
+    def __init__(self):
+        self.received = 0
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen(1)
+        self.port = self.server.getsockname()[1]
+        self.thread = threading.Thread(target=self.__serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.thread.join(timeout=10)
+        self.server.close()
+
+    def __serve(self):
+        connection, address = self.server.accept()
+        while True:
+            data = connection.recv(1048576)
+            if not data:
+                break
+            self.received += len(data)
+        connection.close()
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
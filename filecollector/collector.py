@@ -23,22 +23,56 @@ import argparse
 import sys
 import logging
 import os
-import yaml
 import glob
-import gzip
 import shutil
 import datetime
-import tarfile
-import fileinput
 import re
-import zipfile
 import subprocess
 import socket
 import time
-import platform
-from fluent import sender
-from fluent import event
-from pid import PidFile
+import collections
+import concurrent.futures
+import tempfile
+import json
+import hashlib
+import mmap
+import struct
+import select
+import signal
+import functools
+import contextlib
+import fnmatch
+import stat as statmodule
+import queue
+import threading
+import base64
+
+SPOOL_MAX_SIZE = 16 * 1048576
+SPOOL_CHUNK_SIZE = 1048576
+MMAP_THRESHOLD = 64 * 1048576
+FICLONE = 0x40049409
+COMPRESS_CHUNK_SIZE = 4 * 1048576
+ARCHIVE_EXTENSIONS = {"zip": "zip", "tar": "tar", "gztar": "tar.gz", "bztar": "tar.bz2", "zstdtar": "tar.zst", "lz4tar": "tar.lz4"}
+CONFIG_CACHE_VERSION = 1
+CONFIG_TYPES = {
+    None: {"outputLocation": str, "outputScript": str, "preProcessScript": str, "processFileScript": str, "processFilesFolderScript": str,
+           "compressFormat": str, "workerType": str, "processFileScriptMode": str, "processFileScriptProtocol": str, "stateFile": str, "hostname": str,
+           "compress": bool, "useFullPath": bool, "sortFilesByDate": bool, "deleteProcessedTempFiles": bool, "deleteProcessedTempFilesOneByOne": bool,
+           "deleteCompressedFile": bool, "streamArchive": bool, "incremental": bool, "linkFiles": bool, "checkDiskSpace": bool,
+           "workers": int, "maxFilesInFlight": int, "compressLevel": int, "compressThreads": int, "mmapThreshold": int, "maxArchiveSize": int,
+           "processFileScriptWorkers": int, "requiredDiskSpaceRatio": float, "processFileScriptTimeout": float},
+    "fluentProcessor": {"host": str, "tag": str, "identifier": str, "messageField": str, "includeTime": bool, "requireAck": bool,
+                        "port": int, "batchSize": int, "queueSize": int, "retries": int, "flushInterval": float, "timeout": float},
+    "watch": {"polling": bool, "controlSocket": str, "bundleSize": int, "pollInterval": float, "bundleInterval": float, "rescanInterval": float},
+    "metrics": {"report": bool, "profile": str, "prometheusFile": str},
+    "dedup": {"mode": str, "cacheFolder": str}
+}
+CONFIG_CHOICES = {
+    "compressFormat": sorted(ARCHIVE_EXTENSIONS),
+    "workerType": ["thread", "process"],
+    "processFileScriptMode": ["perFile", "persistent"],
+    "processFileScriptProtocol": ["json", "line"]
+}
 
 def parse_args(args):
     parser = argparse.ArgumentParser(
@@ -51,6 +85,12 @@ def parse_args(args):
                         help='Start (last modified) datestamp (epoh unix format) for the monitored logs')
     parser.add_argument('--end-time', type=float, required=False, dest="end_time",
                         help='End (creation) datestamp (epoh unix format) for the monitored logs (epoh unix format)')       
+    parser.add_argument('--watch', action='store_true', required=False,
+                        help='Run as a daemon: watch the configured files and collect the changes into bundles')
+    parser.add_argument('--config-cache', type=str, required=False, dest="config_cache",
+                        help='Path of the validated configuration cache (default: .<config file name>.cache.json next to the configuration)')
+    parser.add_argument('--no-config-cache', action='store_true', required=False, dest="no_config_cache",
+                        help='Do not use (or write) the validated configuration cache')
     args = parser.parse_args(args)
     return args
 
@@ -59,124 +99,1701 @@ def main(args):
     filteredLabels = args.labels.split(',') if args.labels else []
     startTime=args.start_time
     endTime=args.end_time
-    with open(args.config) as file:
-        config = yaml.load(file, yaml.SafeLoader)
-        if config and "collector" in config:
-            logger=__setup_logger(config)
-            outputLocation=config["collector"]["outputLocation"]
-            outputScript=__get_str_key("outputScript", config["collector"])
-            preProcessScript=__get_str_key("preProcessScript", config["collector"])
-            processFileScript=__get_str_key("processFileScript", config["collector"])
-            files=config["collector"]["files"]
-            useFullPath=__get_bool_key("useFullPath", config["collector"], True)
-            compressFormat=__get_str_key("compressFormat", config["collector"], "zip")
-            now = datetime.datetime.today()
-            nTime = now.strftime("%Y-%m-%d-%H-%M-%S-%f")
-            hostname=None
-            if socket.gethostname().find('.')>=0:
-                hostname=socket.gethostname()
+    collectorConfig=load_config(args.config, args.config_cache, not args.no_config_cache)
+    config=collectorConfig.config
+    if config and "collector" in config:
+        logger=__setup_logger(config)
+        if args.watch:
+            __create_daemon(config, filteredLabels, logger, collectorConfig.hostname, collectorConfig.rule_engine).run()
+        else:
+            collect(config, filteredLabels, startTime, endTime, logger, collectorConfig.hostname, collectorConfig.rule_engine)
+
+def load_config(path, cache_path=None, use_cache=True):
+    """
+    Load and validate the configuration file. The validated configuration (and the resolved hostname) is cached in
+    a JSON file, that is used while the config file is not changed (same path, modification time, size and content
+    checksum), so the YAML parser is not imported and the hostname is not resolved again for the next runs. Only the
+    collector block is cached; if it cannot be written as JSON, the configuration is not cached.
+    """
+    with open(path, 'rb') as configFile:
+        content=configFile.read()
+        stat=os.fstat(configFile.fileno())
+    if cache_path is None:
+        cache_path=os.path.join(os.path.dirname(os.path.abspath(path)), ".%s.cache.json" % os.path.basename(path))
+    version=[CONFIG_CACHE_VERSION, os.path.abspath(path), stat.st_mtime_ns, stat.st_size, hashlib.sha1(content).hexdigest()]
+    cached=None
+    if use_cache and os.path.exists(cache_path):
+        try:
+            with open(cache_path) as cacheFile:
+                cached=json.load(cacheFile)
+        except (OSError, ValueError):
+            cached=None
+    if cached and cached.get("version") == version:
+        config, hostnames=cached["config"], cached["hostnames"]
+    else:
+        import yaml
+        config=__compile_config(yaml.load(content, yaml.SafeLoader))
+        hostnames={}
+    hostname=None
+    if config and "collector" in config:
+        hostname=__get_str_key("hostname", config["collector"])
+        if not hostname:
+            name=socket.gethostname()
+            if name not in hostnames:
+                hostnames={name: get_hostname()}
+            hostname=hostnames[name]
+    if use_cache and (not cached or cached.get("version") != version or cached.get("hostnames") != hostnames):
+        # only the collector block is cached, other blocks (e.g. server) are not used by the collector
+        cachedConfig={"collector": config["collector"]} if config and "collector" in config else None
+        tmpPath="%s.%d.tmp" % (cache_path, os.getpid())
+        try:
+            with open(tmpPath, "w") as cacheFile:
+                json.dump({"version": version, "config": cachedConfig, "hostnames": hostnames}, cacheFile)
+            os.replace(tmpPath, cache_path)
+        except (OSError, TypeError, ValueError) as error:
+            # e.g. YAML dates or binary values cannot be written into JSON, the configuration is not cached then
+            logging.getLogger('filecollector').debug("cannot write configuration cache '%s': %s" % (cache_path, error))
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+    ruleEngine=__create_rule_engine(config["collector"]) if config and "collector" in config else None
+    return CollectorConfig(config, hostname, ruleEngine)
+
+def __compile_config(config):
+    """
+    Check the collector block of the configuration, and convert the known options to their types.
+    """
+    if not config or "collector" not in config:
+        return config
+    if not isinstance(config["collector"], dict):
+        raise ValueError("'collector' configuration block needs to be a map")
+    collectorConfig=config["collector"]
+    for block, types in CONFIG_TYPES.items():
+        values=collectorConfig if block is None else collectorConfig.get(block)
+        if not values:
+            continue
+        if not isinstance(values, dict):
+            raise ValueError("'collector.%s' configuration block needs to be a map" % block)
+        for key, valueType in types.items():
+            if key in values and values[key] is not None:
+                try:
+                    values[key]=valueType(values[key])
+                except (TypeError, ValueError):
+                    raise ValueError("'collector.%s%s' needs to be a %s value" % (block + "." if block else "", key, valueType.__name__))
+    if "outputLocation" not in collectorConfig:
+        raise ValueError("'collector.outputLocation' is required")
+    for key, choices in CONFIG_CHOICES.items():
+        if collectorConfig.get(key) is not None and collectorConfig[key] not in choices:
+            raise ValueError("unsupported %s: %s (use one of: %s)" % (key, collectorConfig[key], ", ".join(choices)))
+    if not isinstance(collectorConfig.get("files"), list):
+        raise ValueError("'collector.files' needs to be a list")
+    for fileObject in collectorConfig["files"]:
+        if not isinstance(fileObject, dict) or "path" not in fileObject or "label" not in fileObject:
+            raise ValueError("every item of 'collector.files' needs a 'path' and a 'label'")
+        fileObject["path"]=str(fileObject["path"])
+        fileObject["label"]=str(fileObject["label"])
+        for key in ["includeLines", "excludeLines", "timestampPattern"]:
+            for pattern in ([fileObject[key]] if isinstance(fileObject.get(key), str) else fileObject.get(key) or []):
+                try:
+                    re.compile(pattern)
+                except re.error as error:
+                    raise ValueError("invalid pattern in 'collector.files.%s' ('%s'): %s" % (key, pattern, error))
+    for rule in collectorConfig.get("rules") or []:
+        if not isinstance(rule, dict) or "pattern" not in rule or "replacement" not in rule:
+            raise ValueError("every item of 'collector.rules' needs a 'pattern' and a 'replacement'")
+        try:
+            re.compile(rule["pattern"])
+        except re.error as error:
+            raise ValueError("invalid pattern in 'collector.rules' ('%s'): %s" % (rule["pattern"], error))
+    return config
+
+class CollectorConfig:
+    """
+    Validated configuration (see load_config), with the resolved hostname and the compiled anonymization rules.
+    """
+
+    def __init__(self, config, hostname=None, rule_engine=None):
+        self.config = config
+        self.hostname = hostname
+        self.rule_engine = rule_engine
+
+def collect(config, filteredLabels, startTime, endTime, logger, hostname=None, ruleEngine=None, paths=None):
+    """
+    Run one collection based on the configuration. If paths is set, only those files are collected (if they match the configured files).
+    """
+    outputLocation=config["collector"]["outputLocation"]
+    outputScript=__get_str_key("outputScript", config["collector"])
+    preProcessScript=__get_str_key("preProcessScript", config["collector"])
+    processFileScript=__get_str_key("processFileScript", config["collector"])
+    files=config["collector"]["files"]
+    useFullPath=__get_bool_key("useFullPath", config["collector"], True)
+    compressFormat=__get_str_key("compressFormat", config["collector"], "zip")
+    now = datetime.datetime.today()
+    nTime = now.strftime("%Y-%m-%d-%H-%M-%S-%f")
+    if hostname is None:
+        hostname=get_hostname()
+    zipfile_name = nTime + "-" + hostname.replace(".", "-")
+    tmp_folder=os.path.abspath(os.path.join(outputLocation, "tmp", zipfile_name))
+    metricsConfig=config["collector"]["metrics"] if "metrics" in config["collector"] and config["collector"]["metrics"] else None
+    metrics=RunMetrics(zipfile_name)
+    profiler=None
+    if metricsConfig and __get_str_key("profile", metricsConfig):
+        import cProfile
+        profiler=cProfile.Profile()
+        profiler.enable()
+    if preProcessScript:
+        with metrics.stage("preProcessScript"):
+            subprocess.call([preProcessScript, tmp_folder])
+
+    fluentEventProcessor = None
+    if "fluentProcessor" in config["collector"]:
+        fluent_host=__get_str_key("host", config["collector"]["fluentProcessor"], "localhost")
+        fluent_port=__get_int_key("port", config["collector"]["fluentProcessor"], 24224)
+        fluent_tag=__get_str_key("tag", config["collector"]["fluentProcessor"])
+        identifier=__get_str_key("identifier", config["collector"]["fluentProcessor"])
+        message_field=__get_str_key("messageField", config["collector"]["fluentProcessor"], "message")
+        include_time=__get_bool_key("includeTime", config["collector"]["fluentProcessor"])
+        batch_size=int(__get_int_key("batchSize", config["collector"]["fluentProcessor"]) or 0)
+        flush_interval=__get_float_key("flushInterval", config["collector"]["fluentProcessor"], 1.0)
+        queue_size=__get_int_key("queueSize", config["collector"]["fluentProcessor"], 8)
+        retries=__get_int_key("retries", config["collector"]["fluentProcessor"], 3)
+        timeout=__get_float_key("timeout", config["collector"]["fluentProcessor"], 3.0)
+        require_ack=__get_bool_key("requireAck", config["collector"]["fluentProcessor"])
+        fluentEventProcessor=EventProcessor(fluent_host, int(fluent_port), fluent_tag, identifier, message_field, include_time,
+                                            batch_size, flush_interval, queue_size, retries, timeout, require_ack)
+    processFilesFolderScript=__get_str_key("processFilesFolderScript", config["collector"])
+    skip_compress=not __get_bool_key("compress", config["collector"], True)
+    keep_processed_files=not __get_bool_key("deleteProcessedTempFiles", config["collector"], True)
+    streamArchive=not skip_compress and __get_bool_key("streamArchive", config["collector"])
+    if streamArchive and (processFileScript or processFilesFolderScript or fluentEventProcessor):
+        logger.warning("'streamArchive' is ignored as processFileScript, processFilesFolderScript and fluentProcessor need the collected files on disk")
+        streamArchive=False
+    if not streamArchive and not os.path.exists(tmp_folder):
+        os.makedirs(tmp_folder)
+    sortFilesByDate=__get_bool_key("sortFilesByDate", config["collector"], True)
+    deleteProcessedTempFilesOneByOne=__get_bool_key("deleteProcessedTempFilesOneByOne", config["collector"])
+    with metrics.stage("discovery"):
+        tasks=__discover_files(files, filteredLabels, tmp_folder, useFullPath, sortFilesByDate, startTime, endTime, logger, paths)
+
+    collectionState=None
+    if __get_bool_key("incremental", config["collector"]):
+        stateFile=__get_str_key("stateFile", config["collector"], os.path.join(outputLocation, ".filecollector-state.json"))
+        with metrics.stage("incrementalState"):
+            collectionState=CollectionState(stateFile, logger)
+            tasks=collectionState.plan(tasks)
+    dedupCache=None
+    dedupConfig=config["collector"]["dedup"] if "dedup" in config["collector"] and config["collector"]["dedup"] else None
+    if dedupConfig:
+        lineFilters=[[fileObject.get("includeLines"), fileObject.get("excludeLines")] for fileObject in files]
+        fingerprint=hashlib.sha1(json.dumps([config["collector"].get("rules"), processFileScript, lineFilters], sort_keys=True).encode("utf-8")).hexdigest()
+        cacheFolder=__get_str_key("cacheFolder", dedupConfig, os.path.join(outputLocation, ".filecollector-cache"))
+        with metrics.stage("dedup"):
+            dedupCache=DedupCache(cacheFolder, fingerprint, zipfile_name, __get_str_key("mode", dedupConfig, "reuse"), logger, partial=paths is not None)
+            tasks=dedupCache.plan(tasks)
+        metrics.count("dedupFiles", len(dedupCache.current))
+    if paths is not None and not tasks:
+        # none of the changed files has new data to collect, no (empty) bundle is created
+        logger.info("no new data in the changed file(s), skipping the bundle")
+        if collectionState:
+            collectionState.save()
+        if os.path.exists(tmp_folder):
+            shutil.rmtree(tmp_folder)
+        if fluentEventProcessor:
+            fluentEventProcessor.close()
+        return
+    with metrics.stage("diskCheck"):
+        __disk_check(tasks, outputLocation, config["collector"], logger)
+    fileSettings={
+        "ruleEngine": ruleEngine if ruleEngine else __create_rule_engine(config["collector"]),
+        "processFileScript": processFileScript,
+        "linkFiles": __get_bool_key("linkFiles", config["collector"]) and not processFileScript and not processFilesFolderScript and not ("rules" in config["collector"] and config["collector"]["rules"]),
+        "mmapThreshold": __get_int_key("mmapThreshold", config["collector"], MMAP_THRESHOLD),
+        "scriptPool": None
+    }
+    if compressFormat not in ARCHIVE_EXTENSIONS:
+        raise ValueError("unsupported compressFormat: %s (use one of: %s)" % (compressFormat, ", ".join(sorted(ARCHIVE_EXTENSIONS))))
+    extension = ARCHIVE_EXTENSIONS[compressFormat]
+    compressLevel=__get_int_key("compressLevel", config["collector"])
+    compressThreads=__get_int_key("compressThreads", config["collector"], 1)
+    output_file=os.path.join(outputLocation, zipfile_name)
+    maxArchiveSize=__get_int_key("maxArchiveSize", config["collector"])
+    deleteCompressedFile=__get_bool_key("deleteCompressedFile", config["collector"])
+    outputExecutor=None
+    outputResults=[]
+    on_volume=None
+    if maxArchiveSize and outputScript and not skip_compress:
+        outputExecutor=concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        def run_output_script(path):
+            with metrics.stage("outputScript"):
+                subprocess.call([outputScript, path])
+            if deleteCompressedFile:
+                os.remove(path)
+        def on_volume(path):
+            logger.debug("archive volume '%s' is finished" % path)
+            outputResults.append((path, outputExecutor.submit(run_output_script, path)))
+
+    archive=None
+    if streamArchive:
+        logger.debug("stream collected files into '%s.%s'" % (output_file, extension))
+        archive=open_archive(output_file, compressFormat, extension, compressLevel, compressThreads, maxArchiveSize, on_volume)
+        def on_file_processed(task, content):
+            try:
+                if dedupCache:
+                    with metrics.stage("dedup"):
+                        dedupCache.update(task, read_chunks(task.path, task.offset, task.end) if content is None else iter(functools.partial(content.read, SPOOL_CHUNK_SIZE), b""))
+                    if content:
+                        content.seek(0)
+                with metrics.stage("archiveWrite"):
+                    archive.add(task.path, os.path.relpath(task.dest, os.path.dirname(tmp_folder)), content)
+                if collectionState:
+                    collectionState.update(task)
+            finally:
+                if content:
+                    content.close()
+        try:
+            with metrics.stage("processFiles"):
+                failures=__process_files(tasks, spool_file, fileSettings, config["collector"], on_file_processed, metrics, logger, allowProcesses=False)
+            if dedupCache and dedupCache.references:
+                with tempfile.NamedTemporaryFile(suffix=".json") as manifestFile:
+                    dedupCache.write_manifest(manifestFile.name, tmp_folder)
+                    archive.add(manifestFile.name, os.path.join(zipfile_name, "dedup.json"))
+        except BaseException:
+            archive.abort()
+            raise
+        with metrics.stage("compression"):
+            archive.close()
+    else:
+        def on_file_processed(task, dest):
+            if dedupCache:
+                with metrics.stage("dedup"):
+                    dedupCache.update(task, read_chunks(dest))
+            if fluentEventProcessor:
+                with metrics.stage("fluent"):
+                    lines, size=fluentEventProcessor.process(task.label, os.path.abspath(task.path), dest)
+                metrics.count("fluentLines", lines)
+                metrics.count("fluentBytes", size)
+            if deleteProcessedTempFilesOneByOne:
+                os.remove(dest)
+            if collectionState:
+                collectionState.update(task)
+        fileSettings["scriptPool"]=__create_script_pool(processFileScript, config["collector"])
+        try:
+            with metrics.stage("processFiles"):
+                failures=__process_files(tasks, process_file, fileSettings, config["collector"], on_file_processed, metrics, logger)
+        finally:
+            if fileSettings["scriptPool"]:
+                fileSettings["scriptPool"].close()
+    if failures:
+        logger.error("%d of %d file(s) could not be processed" % (len(failures), len(tasks)))
+    if dedupCache and dedupCache.references and not streamArchive:
+        dedupCache.write_manifest(os.path.join(tmp_folder, "dedup.json"), tmp_folder)
+
+    if processFilesFolderScript:
+        with metrics.stage("processFilesFolderScript"):
+            subprocess.call([processFilesFolderScript, tmp_folder])
+
+    if skip_compress:
+        print("skipping file compression")
+    elif not streamArchive:
+        with metrics.stage("compression"):
+            archive=make_archive(tmp_folder, output_file, compressFormat, extension, compressLevel, compressThreads, maxArchiveSize, on_volume)
+    if archive:
+        metrics.count("archiveBytes", archive.size())
+        if maxArchiveSize:
+            metrics.count("archiveVolumes", len(archive.volumes))
+    if collectionState:
+        collectionState.save()
+    if dedupCache:
+        with metrics.stage("dedup"):
+            dedupCache.save()
+
+    if keep_processed_files:
+        print("keep processed files in '%s' folder" % os.path.join(outputLocation, "tmp"))
+    elif os.path.exists(os.path.join(outputLocation, "tmp")):
+        shutil.rmtree(os.path.join(outputLocation, "tmp"))
+
+    if outputExecutor:
+        on_volume(archive.manifest_path)
+        outputExecutor.shutdown(wait=True)
+        for path, result in outputResults:
+            if result.exception():
+                logger.error("outputScript failed for '%s': %s" % (path, result.exception()))
+    elif not skip_compress and outputScript:
+        output_compressed_file="%s.%s" % (output_file, extension)
+        with metrics.stage("outputScript"):
+            subprocess.call([outputScript, output_compressed_file])
+        if deleteCompressedFile:
+           os.remove(output_compressed_file)
+    if fluentEventProcessor:
+        with metrics.stage("fluent"):
+            metrics.count("fluentFailedEvents", fluentEventProcessor.close() or 0)
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats(__get_str_key("profile", metricsConfig))
+    if metricsConfig:
+        metrics.finish()
+        if __get_bool_key("report", metricsConfig, True):
+            metrics.write_report(os.path.join(outputLocation, "%s.report.json" % zipfile_name))
+        if __get_str_key("prometheusFile", metricsConfig):
+            metrics.write_prometheus(__get_str_key("prometheusFile", metricsConfig))
+
+def stream_files(config, filteredLabels, startTime, endTime, logger, grep=None, hostname=None):
+    """
+    Run the discovery and the anonymization rules of the collector without a tmp folder or an archive. Yields
+    (task, arcname, chunks) for every collected file, where chunks is a generator of the processed content (only the
+    lines that match one of the grep patterns, if it is set), or None if the byte range of the source can be used as is.
+    """
+    if hostname is None:
+        hostname=get_hostname()
+    name=datetime.datetime.today().strftime("%Y-%m-%d-%H-%M-%S-%f") + "-" + hostname.replace(".", "-")
+    base_folder=os.path.join(os.sep, name)
+    tasks=__discover_files(config["collector"]["files"], filteredLabels, base_folder, __get_bool_key("useFullPath", config["collector"], True),
+                           __get_bool_key("sortFilesByDate", config["collector"], True), startTime, endTime, logger)
+    ruleEngine=__create_rule_engine(config["collector"])
+    lineFilter=LineFilter(grep) if grep else None
+    for task in tasks:
+        if not task.is_file():
+            continue
+        arcname=os.path.relpath(task.dest, os.sep)
+        if task.line_filter or ruleEngine or lineFilter:
+            chunks=filter_chunks(read_chunks(task.path, task.offset, task.end, whole_lines=True), None, task.line_filter)
+            yield task, arcname, filter_chunks(chunks, ruleEngine, lineFilter)
+        else:
+            yield task, arcname, None
+
+def filter_chunks(chunks, ruleEngine=None, lineFilter=None, stats=None):
+    """
+    Filter (lines) and anonymize chunks that end at line ends, empty chunks are dropped.
+    Read bytes (before filtering), lines and substitutions are counted into stats (if it is set).
+    """
+    for data in chunks:
+        if stats is not None:
+            stats["bytes"]+=len(data)
+        if lineFilter:
+            data=lineFilter.filter(data)
+        if ruleEngine and data:
+            data=ruleEngine.apply_text(data.decode("utf-8", "surrogateescape"), stats).encode("utf-8", "surrogateescape")
+        if data:
+            yield data
+
+def get_hostname():
+    if socket.gethostname().find('.')>=0:
+        return socket.gethostname()
+    else:
+        return socket.gethostbyaddr(socket.gethostname())[0]
+
+def __create_daemon(config, filteredLabels, logger, hostname=None, ruleEngine=None):
+    watchConfig=config["collector"]["watch"] if "watch" in config["collector"] and config["collector"]["watch"] else {}
+    watcher=None
+    if not __get_bool_key("polling", watchConfig):
+        try:
+            watcher=InotifyWatcher()
+        except (OSError, AttributeError) as error:
+            logger.warning("inotify is not available, using polling for watching files: %s" % error)
+    if watcher is None:
+        watcher=PollingWatcher(__get_float_key("pollInterval", watchConfig, 2.0))
+    return CollectorDaemon(config, filteredLabels, logger, watcher,
+                           bundleInterval=__get_float_key("bundleInterval", watchConfig, 60.0),
+                           bundleSize=__get_int_key("bundleSize", watchConfig, 100 * 1048576),
+                           rescanInterval=__get_float_key("rescanInterval", watchConfig, 60.0),
+                           controlSocket=__get_str_key("controlSocket", watchConfig),
+                           hostname=hostname if hostname else get_hostname(),
+                           ruleEngine=ruleEngine if ruleEngine else __create_rule_engine(config["collector"]))
+
+def __create_script_pool(processFileScript, config):
+    mode=__get_str_key("processFileScriptMode", config, "perFile")
+    if not processFileScript or mode == "perFile":
+        return None
+    if mode != "persistent":
+        raise ValueError("unsupported processFileScriptMode: %s (use 'perFile' or 'persistent')" % mode)
+    return ScriptWorkerPool(processFileScript,
+                            workers=__get_int_key("processFileScriptWorkers", config, 1),
+                            timeout=__get_float_key("processFileScriptTimeout", config, 60.0),
+                            protocol=__get_str_key("processFileScriptProtocol", config, "json"))
+
+def __create_rule_engine(config):
+    return RuleEngine(config["rules"]) if "rules" in config and config["rules"] else None
+
+def open_archive(destination, format, extension, level=None, threads=1, max_size=None, on_volume=None):
+    """
+    Create an archive writer: numbered volumes (with a manifest) if max_size is set, otherwise one archive file.
+    """
+    if max_size:
+        return VolumeWriter(destination, format, extension, level, threads, max_size, on_volume)
+    return ArchiveWriter(destination, format, extension, level, threads)
+
+def make_archive(source, destination, format, extension, level=None, threads=1, max_size=None, on_volume=None):
+    archive_to = os.path.basename(source.strip(os.sep))
+    archive = open_archive(destination, format, extension, level, threads, max_size, on_volume)
+    try:
+        archive.add_tree(source, archive_to)
+    except BaseException:
+        archive.abort()
+        raise
+    archive.close()
+    return archive
+
+def process_file(task, settings):
+    """
+    Copy one collected file into its destination, then run the anonymization rules and the processFileScript on it
+    (or copy its cached output, if it is unchanged since an earlier run).
+    Runs inside the worker pool, so it only gets picklable inputs.
+    """
+    file, dest = task.path, task.dest
+    stats=new_file_stats()
+    dest_parent=os.path.dirname(dest)
+    os.makedirs(dest_parent, exist_ok=True)
+    ruleEngine=settings["ruleEngine"]
+    if task.cached:
+        start=time.time()
+        # copied (not linked), so the scripts that change the tmp folder cannot change the cache
+        copy_file(task.cached, dest, os.stat(task.cached))
+        stats["stages"]["dedup"]=time.time() - start
+        return dest, stats
+    if task.is_file():
+        start=time.time()
+        if task.line_filter:
+            with open(dest, 'wb') as outfile:
+                for chunk in filter_chunks(read_chunks(file, task.offset, task.end, whole_lines=True), ruleEngine, task.line_filter, stats):
+                    outfile.write(chunk)
+            os.chmod(dest, statmodule.S_IMODE(task.stat.st_mode))
+            stats["stages"]["rules"]=time.time() - start
+        elif ruleEngine:
+            ruleEngine.anonymize(file, dest, task.offset, task.end, stats)
+            os.chmod(dest, statmodule.S_IMODE(task.stat.st_mode))
+            stats["stages"]["rules"]=time.time() - start
+        else:
+            method=copy_file(file, dest, task.stat, task.offset, task.end, settings["linkFiles"], settings["mmapThreshold"])
+            logging.getLogger('filecollector').debug("file '%s' copied with %s" % (file, method))
+            stats["bytes"]=task.size()
+            stats["stages"]["copy"]=time.time() - start
+    if settings["processFileScript"]:
+        start=time.time()
+        if settings["scriptPool"]:
+            settings["scriptPool"].process(dest, task.label)
+        else:
+            subprocess.call([settings["processFileScript"], dest, task.label])
+        stats["stages"]["processFileScript"]=time.time() - start
+    return dest, stats
+
+def copy_file(source, dest, stat, start=0, end=None, link=False, mmap_threshold=MMAP_THRESHOLD):
+    """
+    Copy the [start, end) byte range of the source file into dest with the fastest method that works:
+    hard link (if enabled, whole files on the same filesystem only), reflink, copy_file_range, sendfile,
+    mmap (ranges from mmap_threshold) or buffered read/write. Returns the name of the used method.
+    """
+    end = stat.st_size if end is None else end
+    whole = start == 0 and end >= stat.st_size
+    if link and whole:
+        try:
+            if os.path.lexists(dest):
+                os.remove(dest)
+            os.link(source, dest)
+            return "link"
+        except OSError:
+            pass
+    with open(source, 'rb') as infile, open(dest, 'wb') as outfile:
+        if whole and __reflink(infile, outfile):
+            method = "reflink"
+        else:
+            method = __copy_range(infile, outfile, start, end, mmap_threshold)
+    os.chmod(dest, statmodule.S_IMODE(stat.st_mode))
+    return method
+
+def __reflink(infile, outfile):
+    try:
+        import fcntl
+        fcntl.ioctl(outfile.fileno(), FICLONE, infile.fileno())
+        return True
+    except (ImportError, OSError):
+        return False
+
+def __copy_range(infile, outfile, start, end, mmap_threshold):
+    # every method continues from the offset where the previous one failed
+    offset = start
+    if hasattr(os, "copy_file_range"):
+        try:
+            while offset < end:
+                copied = os.copy_file_range(infile.fileno(), outfile.fileno(), end - offset, offset)
+                if copied == 0:
+                    break
+                offset += copied
+            return "copy_file_range"
+        except OSError:
+            pass
+    if hasattr(os, "sendfile"):
+        try:
+            while offset < end:
+                sent = os.sendfile(outfile.fileno(), infile.fileno(), offset, min(end - offset, 0x7ffff000))
+                if sent == 0:
+                    break
+                offset += sent
+            return "sendfile"
+        except OSError:
+            pass
+    if end - offset >= mmap_threshold:
+        try:
+            with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                view = memoryview(mapped)
+                try:
+                    while offset < end:
+                        offset += outfile.write(view[offset:min(end, offset + SPOOL_CHUNK_SIZE)])
+                finally:
+                    view.release()
+            return "mmap"
+        except (OSError, ValueError):
+            pass
+    infile.seek(offset)
+    while offset < end:
+        data = infile.read(min(SPOOL_CHUNK_SIZE, end - offset))
+        if not data:
+            break
+        outfile.write(data)
+        offset += len(data)
+    return "read/write"
+
+def spool_file(task, settings):
+    """
+    Anonymize one collected file into a temporary file (kept in memory up to a limit) for streaming archives.
+    Returns None if the file can be added to the archive as is.
+    """
+    ruleEngine=settings["ruleEngine"]
+    stats=new_file_stats()
+    if not task.is_file():
+        return None, stats
+    if task.cached:
+        return open(task.cached, 'rb'), stats
+    if not (ruleEngine or task.line_filter or task.is_partial()):
+        stats["bytes"]=task.size()
+        return None, stats
+    start=time.time()
+    content=tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    try:
+        if task.line_filter:
+            chunks=filter_chunks(read_chunks(task.path, task.offset, task.end, whole_lines=True), ruleEngine, task.line_filter, stats)
+        elif ruleEngine:
+            chunks=ruleEngine.chunks(task.path, task.offset, task.end, stats)
+        else:
+            chunks=read_chunks(task.path, task.offset, task.end)
+            stats["bytes"]=task.size()
+        for chunk in chunks:
+            content.write(chunk)
+    except BaseException:
+        content.close()
+        raise
+    content.seek(0)
+    stats["stages"]["rules" if ruleEngine or task.line_filter else "copy"]=time.time() - start
+    return content, stats
+
+def new_file_stats():
+    return {"bytes": 0, "lines": 0, "substitutions": 0, "stages": {}}
+
+def __process_files(tasks, worker, settings, config, on_file_processed, metrics, logger, allowProcesses=True):
+    workers=__get_int_key("workers", config, 1)
+    workerType=__get_str_key("workerType", config, "thread")
+    if workerType == "process" and not allowProcesses:
+        logger.debug("using thread workers instead of process workers")
+        workerType="thread"
+    maxFilesInFlight=max(__get_int_key("maxFilesInFlight", config, workers * 2), workers)
+    failures=[]
+    def finish(task, future):
+        try:
+            result, stats=future.result() if future else worker(task, settings)
+            metrics.add_file(task.label, stats)
+            on_file_processed(task, result)
+        except Exception as error:
+            logger.error("processing file '%s' failed: %s" % (os.path.abspath(task.path), error))
+            metrics.count("failedFiles")
+            failures.append((task, error))
+    if workers <= 1:
+        for task in tasks:
+            logger.debug("process file: %s" % os.path.abspath(task.path))
+            finish(task, None)
+        return failures
+    if workerType == "process":
+        executor=concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+    elif workerType == "thread":
+        executor=concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    else:
+        raise ValueError("unsupported workerType: %s (use 'thread' or 'process')" % workerType)
+    logger.debug("process files with %d %s worker(s), max files in flight: %d" % (workers, workerType, maxFilesInFlight))
+    with executor:
+        pending=collections.deque()
+        for task in tasks:
+            logger.debug("process file: %s" % os.path.abspath(task.path))
+            pending.append((task, executor.submit(worker, task, settings)))
+            if len(pending) >= maxFilesInFlight:
+                finish(*pending.popleft())
+        while pending:
+            finish(*pending.popleft())
+    return failures
+
+def read_chunks(path, start=0, end=None, chunk_size=SPOOL_CHUNK_SIZE, whole_lines=False):
+    """
+    Read the [start, end) byte range of a file in chunks. With whole_lines, every chunk ends at a line end
+    (or at the end of the range).
+    """
+    with open(path, 'rb') as infile:
+        if start:
+            infile.seek(start)
+        remaining = None if end is None else end - start
+        while remaining is None or remaining > 0:
+            data = infile.read(chunk_size if remaining is None else min(chunk_size, remaining))
+            if not data:
+                break
+            if whole_lines and not data.endswith(b"\n"):
+                data += infile.readline() if remaining is None else infile.readline(remaining - len(data))
+            if remaining is not None:
+                remaining -= len(data)
+            yield data
+
+class CollectedFile:
+    """
+    A matched file that needs to be collected: its label, source path, destination path inside the
+    collection folder, stat result (taken at discovery) and the byte range of the source that needs
+    to be collected (end=None: until EOF). If cached is set, it is the already processed output of the file,
+    line_filter (LineFilter) is applied on the lines of the file before the rules. active is set for the most
+    recently modified file of a files entry (the log that is still written).
+    """
+
+    def __init__(self, label, path, dest, stat, offset=0, end=None):
+        self.label = label
+        self.path = path
+        self.dest = dest
+        self.stat = stat
+        self.offset = offset
+        self.end = end
+        self.cached = None
+        self.line_filter = None
+        self.active = True
+
+    def is_file(self):
+        return statmodule.S_ISREG(self.stat.st_mode)
+
+    def is_partial(self):
+        return self.offset > 0 or self.end is not None
+
+    def size(self):
+        return (self.stat.st_size if self.end is None else self.end) - self.offset
+
+class FileIndex:
+    """
+    Glob implementation for one collection run that caches directory listings (os.scandir) and stat results,
+    so every directory is scanned and every file is stat'ed only once, even if it is matched by more patterns
+    (paths, excludes). Matching follows glob.glob (non-recursive, hidden files are matched only by patterns
+    starting with a dot).
+    """
+
+    def __init__(self):
+        self.listings = {}
+        self.patterns = {}
+        self.stats = {}
+
+    def glob(self, pattern):
+        dirname, basename = os.path.split(pattern)
+        if not glob.has_magic(pattern):
+            return [pattern] if self.stat(pattern, follow_symlinks=False) else []
+        if not dirname:
+            dirs = [dirname]
+        elif glob.has_magic(dirname) and dirname != pattern:
+            dirs = [directory for directory in self.glob(dirname) if self.__is_dir(directory)]
+        else:
+            dirs = [dirname]
+        result = []
+        for directory in dirs:
+            if not basename:
+                result.append(os.path.join(directory, basename))
+            elif glob.has_magic(basename):
+                matcher = self.__compile(basename)
+                for name in self.listdir(directory):
+                    if (basename.startswith(".") or not name.startswith(".")) and matcher(name):
+                        result.append(os.path.join(directory, name))
+            elif basename in self.listdir(directory):
+                result.append(os.path.join(directory, basename))
+        return result
+
+    @staticmethod
+    def match(pattern, path):
+        """
+        Check a path against a glob pattern (with the same rules as glob), without touching the filesystem.
+        """
+        patternParts = os.path.normpath(pattern).split(os.sep)
+        pathParts = os.path.normpath(path).split(os.sep)
+        if len(patternParts) != len(pathParts):
+            return False
+        for patternPart, pathPart in zip(patternParts, pathParts):
+            if not glob.has_magic(patternPart):
+                if os.path.normcase(patternPart) != os.path.normcase(pathPart):
+                    return False
+            elif (pathPart.startswith(".") and not patternPart.startswith(".")) or not fnmatch.fnmatch(pathPart, patternPart):
+                return False
+        return True
+
+    def stat(self, path, follow_symlinks=True):
+        """
+        Cached stat result of a path, None if it does not exist.
+        """
+        key = (path, follow_symlinks)
+        if key not in self.stats:
+            directory, name = os.path.split(path)
+            entry = self.listings.get(directory or os.curdir, {}).get(name)
+            try:
+                self.stats[key] = entry.stat(follow_symlinks=follow_symlinks) if entry else os.stat(path, follow_symlinks=follow_symlinks)
+            except OSError:
+                self.stats[key] = None
+        return self.stats[key]
+
+    def __is_dir(self, path):
+        stat = self.stat(path)
+        return stat is not None and statmodule.S_ISDIR(stat.st_mode)
+
+    def listdir(self, directory):
+        """
+        Cached directory listing (name -> os.DirEntry).
+        """
+        directory = directory or os.curdir
+        if directory not in self.listings:
+            try:
+                self.listings[directory] = dict((entry.name, entry) for entry in os.scandir(directory))
+            except OSError:
+                self.listings[directory] = {}
+        return self.listings[directory]
+
+    def __compile(self, pattern):
+        if pattern not in self.patterns:
+            self.patterns[pattern] = re.compile(fnmatch.translate(os.path.normcase(pattern))).match
+        matcher = self.patterns[pattern]
+        return lambda name: matcher(os.path.normcase(name))
+
+class InotifyWatcher:
+    """
+    Reports created, modified and moved files in the watched directories with Linux inotify (through ctypes).
+    If the kernel event queue overflows, overflow is set, and the changes need to be found with a rescan.
+    """
+
+    IN_MODIFY = 0x2
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    EVENT_HEADER = struct.Struct("iIII")
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.get_errno = ctypes.get_errno
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = self.get_errno()
+            raise OSError(errno, "inotify_init1 failed: %s" % os.strerror(errno))
+        self.watches = {}
+        self.directories = {}
+        self.overflow = False
+
+    def watch(self, directory):
+        if directory in self.directories:
+            return
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory or os.curdir),
+                                         self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE)
+        if wd < 0:
+            errno = self.get_errno()
+            raise OSError(errno, "cannot watch '%s': %s" % (directory, os.strerror(errno)))
+        self.watches[wd] = directory
+        self.directories[directory] = wd
+
+    def changes(self, timeout):
+        result = set()
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return result
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return result
+        offset = 0
+        while offset + self.EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = self.EVENT_HEADER.unpack_from(data, offset)
+            name = data[offset + self.EVENT_HEADER.size:offset + self.EVENT_HEADER.size + length].rstrip(b"\0")
+            offset += self.EVENT_HEADER.size + length
+            if mask & self.IN_Q_OVERFLOW:
+                self.overflow = True
+            elif mask & self.IN_IGNORED:
+                directory = self.watches.pop(wd, None)
+                self.directories.pop(directory, None)
+            elif name and wd in self.watches:
+                result.add(os.path.join(self.watches[wd], os.fsdecode(name)))
+        return result
+
+    def close(self):
+        os.close(self.fd)
+
+class PollingWatcher:
+    """
+    Fallback for InotifyWatcher: lists the watched directories in every poll interval and reports the files
+    with changed inode, size or modification time.
+    """
+
+    def __init__(self, interval=2.0):
+        self.interval = interval
+        self.directories = {}
+        self.overflow = False
+        self.last_poll = time.time()
+
+    def watch(self, directory):
+        if directory not in self.directories:
+            self.directories[directory] = self.__snapshot(directory)
+
+    def changes(self, timeout):
+        wait = self.last_poll + self.interval - time.time()
+        if wait > 0:
+            time.sleep(min(wait, timeout))
+            if wait > timeout:
+                return set()
+        self.last_poll = time.time()
+        result = set()
+        for directory, files in list(self.directories.items()):
+            snapshot = self.__snapshot(directory)
+            for name, version in snapshot.items():
+                if files.get(name) != version:
+                    result.add(os.path.join(directory, name))
+            self.directories[directory] = snapshot
+        return result
+
+    def close(self):
+        pass
+
+    def __snapshot(self, directory):
+        snapshot = {}
+        try:
+            for entry in os.scandir(directory or os.curdir):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                snapshot[entry.name] = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        except OSError:
+            pass
+        return snapshot
+
+class CollectorDaemon:
+    """
+    Long running collector (--watch). The configuration is loaded once, the directories of the configured files are
+    watched, and the changed files are collected incrementally into bundles when bundleInterval has passed since the
+    last bundle, when the changed files grew by bundleSize bytes, or on an external trigger (SIGUSR1 or a 'collect'
+    command on the control socket). SIGTERM/SIGINT (or a 'stop' command) collect the pending changes and stop.
+    """
+
+    def __init__(self, config, filteredLabels, logger, watcher, bundleInterval=60.0, bundleSize=100 * 1048576,
+                 rescanInterval=60.0, controlSocket=None, hostname=None, ruleEngine=None):
+        self.config = dict(config)
+        self.config["collector"] = dict(config["collector"])
+        self.config["collector"]["incremental"] = True
+        self.filteredLabels = filteredLabels
+        self.logger = logger
+        self.watcher = watcher
+        self.bundleInterval = bundleInterval
+        self.bundleSize = bundleSize
+        self.rescanInterval = rescanInterval
+        self.controlSocket = controlSocket
+        self.hostname = hostname
+        self.ruleEngine = ruleEngine
+        self.pending = set()
+        self.pendingBytes = 0
+        self.sizes = {}
+        self.triggered = threading.Event()
+        self.stopped = threading.Event()
+        self.server = None
+
+    def trigger(self):
+        self.triggered.set()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+            signal.signal(signal.SIGINT, lambda signum, frame: self.stop())
+            if hasattr(signal, "SIGUSR1"):
+                signal.signal(signal.SIGUSR1, lambda signum, frame: self.trigger())
+        if self.controlSocket:
+            self.__start_control_socket()
+        try:
+            self.__collect(None)
+            self.__refresh_watches()
+            lastBundle = lastRescan = time.time()
+            while not self.stopped.is_set():
+                for path in self.watcher.changes(0.5):
+                    self.__add_pending(path)
+                now = time.time()
+                if now - lastRescan >= self.rescanInterval:
+                    self.__refresh_watches()
+                    lastRescan = now
+                if self.triggered.is_set() or self.watcher.overflow:
+                    self.__collect(None)
+                    lastBundle = time.time()
+                elif self.pending and (now - lastBundle >= self.bundleInterval or self.pendingBytes >= self.bundleSize):
+                    self.__collect(self.pending)
+                    lastBundle = time.time()
+            if self.pending:
+                self.__collect(self.pending)
+        finally:
+            self.watcher.close()
+            if self.server:
+                self.server.close()
+                if os.path.exists(self.controlSocket):
+                    os.remove(self.controlSocket)
+
+    def __collect(self, paths):
+        """
+        Collect the changed paths (or every configured file, if paths is None) into a new bundle.
+        """
+        self.triggered.clear()
+        self.watcher.overflow = False
+        self.logger.info("collecting %s" % ("every file" if paths is None else "%d changed file(s)" % len(paths)))
+        try:
+            collect(self.config, self.filteredLabels, None, None, self.logger, self.hostname, self.ruleEngine,
+                    None if paths is None else sorted(paths))
+        except Exception as error:
+            self.logger.exception("collection failed: %s" % error)
+        for path in self.pending:
+            self.__update_size(path)
+        self.pending = set()
+        self.pendingBytes = 0
+
+    def __add_pending(self, path):
+        if not self.__is_collected(path):
+            return
+        previous = self.sizes.get(path)
+        size = self.__update_size(path)
+        if size is None:
+            return
+        self.pending.add(path)
+        self.pendingBytes += size if previous is None or size < previous else size - previous
+
+    def __is_collected(self, path):
+        # changes of files that are not matched by the (label filtered) files and excludes do not count for the next bundle
+        for fileObject in self.config["collector"]["files"]:
+            if self.filteredLabels and fileObject["label"] not in self.filteredLabels:
+                continue
+            if FileIndex.match(fileObject["path"], path) and not any(FileIndex.match(exclude, path) for exclude in fileObject.get("excludes", [])):
+                return True
+        return False
+
+    def __update_size(self, path):
+        try:
+            size = os.stat(path).st_size
+        except OSError:
+            self.sizes.pop(path, None)
+            return None
+        self.sizes[path] = size
+        return size
+
+    def __refresh_watches(self):
+        fileIndex = FileIndex()
+        for fileObject in self.config["collector"]["files"]:
+            if self.filteredLabels and fileObject["label"] not in self.filteredLabels:
+                continue
+            directory = os.path.dirname(fileObject["path"])
+            directories = [match for match in fileIndex.glob(directory) if os.path.isdir(match)] if glob.has_magic(directory) else [directory]
+            for directory in directories:
+                try:
+                    if directory not in getattr(self.watcher, "directories", {}):
+                        for name, entry in list(fileIndex.listdir(directory).items()):
+                            stat = fileIndex.stat(os.path.join(directory, name))
+                            if stat is not None:
+                                self.sizes.setdefault(os.path.join(directory, name), stat.st_size)
+                    self.watcher.watch(directory)
+                except OSError as error:
+                    self.logger.warning("cannot watch folder '%s': %s" % (directory, error))
+
+    def __start_control_socket(self):
+        if os.path.exists(self.controlSocket):
+            os.remove(self.controlSocket)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.controlSocket)
+        self.server.listen(5)
+        thread = threading.Thread(target=self.__serve_control_socket, name="filecollector-control-socket")
+        thread.daemon = True
+        thread.start()
+
+    def __serve_control_socket(self):
+        while not self.stopped.is_set():
+            try:
+                connection, address = self.server.accept()
+            except OSError:
+                return
+            with connection:
+                command = connection.makefile("r").readline().strip()
+                if command == "collect":
+                    self.trigger()
+                elif command == "stop":
+                    self.stop()
+                elif command == "status":
+                    connection.sendall(("%s\n" % json.dumps({"pendingFiles": len(self.pending), "pendingBytes": self.pendingBytes})).encode())
+                    continue
+                else:
+                    connection.sendall(b"unknown command\n")
+                    continue
+                connection.sendall(b"ok\n")
+
+class ScriptWorkerPool:
+    """
+    Persistent processFileScript processes (started once, up to the number of workers), instead of one process per file.
+    Every file is sent as a record on the stdin of an idle script process: a JSON object per line
+    ({"id": ..., "path": ..., "label": ...}) with the json protocol, or "<path>\\t<label>" with the line protocol.
+    The script has to answer every record with one line on its stdout: "ok" (or a JSON object with "status": "ok"),
+    anything else is reported as an error for that file. A script that does not answer in time (or exits) is killed,
+    and it is started again for the next file.
+    """
+
+    instances = {}
+
+    def __init__(self, command, workers=1, timeout=60.0, protocol="json"):
+        if protocol not in ("json", "line"):
+            raise ValueError("unsupported processFileScriptProtocol: %s (use 'json' or 'line')" % protocol)
+        self.command = command
+        self.workers = max(workers, 1)
+        self.timeout = timeout
+        self.protocol = protocol
+        self.logger = logging.getLogger('filecollector')
+        self.lock = threading.Lock()
+        self.processes = []
+        self.idle = queue.Queue()
+        self.next_id = 0
+        for i in range(self.workers):
+            self.idle.put(None)
+
+    def __reduce__(self):
+        # process workers get one (lazily started) pool per worker process instead of a copy per file
+        return (ScriptWorkerPool.shared, (self.command, self.workers, self.timeout, self.protocol))
+
+    @staticmethod
+    def shared(command, workers, timeout, protocol):
+        key = (os.getpid(), command, workers, timeout, protocol)
+        if key not in ScriptWorkerPool.instances:
+            ScriptWorkerPool.instances[key] = ScriptWorkerPool(command, workers, timeout, protocol)
+        return ScriptWorkerPool.instances[key]
+
+    def process(self, path, label):
+        """
+        Send one file to an idle script process and wait for its answer. Blocks while all the script processes are busy.
+        """
+        worker = self.idle.get()
+        try:
+            if worker is None:
+                worker = self.__start()
+            with self.lock:
+                self.next_id += 1
+                record_id = self.next_id
+            if self.protocol == "json":
+                record = json.dumps({"id": record_id, "path": path, "label": label})
             else:
-                hostname=socket.gethostbyaddr(socket.gethostname())[0]
-            zipfile_name = nTime + "-" + hostname.replace(".", "-")
-            tmp_folder=os.path.abspath(os.path.join(outputLocation, "tmp", zipfile_name))
-            if preProcessScript:
-                subprocess.call([preProcessScript, tmp_folder])
-            
-            fluentEventProcessor = None
-            if "fluentProcessor" in config["collector"]:
-                fluent_host=__get_str_key("host", config["collector"]["fluentProcessor"], "localhost")
-                fluent_port=__get_int_key("port", config["collector"]["fluentProcessor"], 24224)
-                fluent_tag=__get_str_key("tag", config["collector"]["fluentProcessor"])
-                identifier=__get_str_key("identifier", config["collector"]["fluentProcessor"])
-                message_field=__get_str_key("messageField", config["collector"]["fluentProcessor"], "message")
-                include_time=__get_bool_key("includeTime", config["collector"]["fluentProcessor"])
-                fluentEventProcessor=EventProcessor(fluent_host, int(fluent_port), fluent_tag, identifier, message_field, include_time)
-            if not os.path.exists(tmp_folder):
-                os.makedirs(tmp_folder)
-            __disk_check(files, filteredLabels, outputLocation, config["collector"], startTime, endTime, logger)
-            for fileObject in files:
-                if filteredLabels and fileObject["label"] not in filteredLabels:
+                record = "%s\t%s" % (path, label)
+            try:
+                worker["process"].stdin.write((record + "\n").encode("utf-8"))
+                worker["process"].stdin.flush()
+                answer = self.__read_line(worker, time.time() + self.timeout)
+            except (OSError, ValueError) as error:
+                self.__stop(worker)
+                worker = None
+                raise RuntimeError("processFileScript '%s' failed: %s" % (self.command, error))
+            self.__check_answer(answer, record_id)
+        finally:
+            self.idle.put(worker)
+
+    def close(self):
+        with self.lock:
+            processes, self.processes = self.processes, []
+        for worker in processes:
+            try:
+                worker["process"].stdin.close()
+            except OSError:
+                pass
+        for worker in processes:
+            try:
+                worker["process"].wait(self.timeout)
+            except subprocess.TimeoutExpired:
+                self.logger.warning("processFileScript '%s' did not exit in time, killing it" % self.command)
+                self.__stop(worker)
+
+    def __start(self):
+        process = subprocess.Popen([self.command], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.logger.debug("started persistent processFileScript '%s' (pid: %d)" % (self.command, process.pid))
+        worker = {"process": process, "buffer": b""}
+        with self.lock:
+            self.processes.append(worker)
+        return worker
+
+    def __stop(self, worker):
+        with self.lock:
+            if worker in self.processes:
+                self.processes.remove(worker)
+        worker["process"].kill()
+        worker["process"].wait()
+        for stream in (worker["process"].stdin, worker["process"].stdout):
+            try:
+                stream.close()
+            except OSError:
+                pass
+
+    def __read_line(self, worker, deadline):
+        fd = worker["process"].stdout.fileno()
+        while b"\n" not in worker["buffer"]:
+            remaining = deadline - time.time()
+            if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+                raise OSError("no answer in %.1f seconds" % self.timeout)
+            data = os.read(fd, 65536)
+            if not data:
+                raise OSError("script exited with code %s" % worker["process"].wait())
+            worker["buffer"] += data
+        line, worker["buffer"] = worker["buffer"].split(b"\n", 1)
+        return line.decode("utf-8", "replace").strip()
+
+    def __check_answer(self, answer, record_id):
+        if answer.lower() == "ok":
+            return
+        if self.protocol == "json" and answer.startswith("{"):
+            try:
+                response = json.loads(answer)
+            except ValueError:
+                response = None
+            if isinstance(response, dict):
+                if "id" in response and response["id"] != record_id:
+                    raise RuntimeError("processFileScript answered record %s instead of %s" % (response["id"], record_id))
+                if str(response.get("status", "")).lower() == "ok":
+                    return
+                raise RuntimeError("processFileScript failed: %s" % response.get("error", answer))
+        raise RuntimeError("processFileScript failed: %s" % answer)
+
+class CollectionState:
+    """
+    State of the incremental collection: for every collected file (keyed by device and inode, so rotated
+    files are recognized under their new name) it stores the size, the last modification time, the last
+    collected byte offset and a checksum of the file head (to detect truncated or replaced files).
+    Records of files that are not checked in a run (other labels, time window or daemon paths) are kept until the file is deleted.
+    """
+
+    HEAD_SIZE = 4096
+
+    def __init__(self, path, logger):
+        self.path = path
+        self.logger = logger
+        self.records = {}
+        self.seen = {}
+        self.collected = {}
+        if os.path.exists(path):
+            try:
+                with open(path) as stateFile:
+                    self.records = json.load(stateFile)
+            except ValueError as error:
+                logger.warning("cannot read collection state file '%s', collecting every file: %s" % (path, error))
+
+    def plan(self, tasks):
+        """
+        Set the byte range to collect for every file (within the range set at discovery). Files without new data are dropped from the result.
+        """
+        result = []
+        for task in tasks:
+            stat = task.stat
+            key = "%d:%d" % (stat.st_dev, stat.st_ino)
+            if key in self.seen:
+                continue
+            record = self.records.get(key)
+            offset = 0
+            if record:
+                self.collected[key] = record
+                if stat.st_size < record["offset"]:
+                    self.logger.debug("file '%s' is truncated, collect it from the beginning" % task.path)
+                elif self.__checksum(task.path, min(record["offset"], self.HEAD_SIZE)) != record["checksum"]:
+                    self.logger.debug("file '%s' is replaced, collect it from the beginning" % task.path)
+                else:
+                    offset = record["offset"]
+            rotated = record is not None and record["path"] != os.path.abspath(task.path)
+            unchanged = record is not None and record["size"] == stat.st_size and record["mtime"] == stat.st_mtime
+            if rotated or unchanged or not task.active:
+                end = stat.st_size
+            else:
+                end = self.__last_line_end(task.path, offset, stat.st_size)
+            if task.end is not None:
+                # the data after the time window is collected in a later run
+                end = max(offset, min(end, task.end))
+            self.seen[key] = {"path": os.path.abspath(task.path), "size": stat.st_size, "mtime": stat.st_mtime, "offset": end}
+            if end <= offset:
+                self.logger.debug("file '%s' has no new data since the last collection" % task.path)
+                continue
+            offset = max(offset, task.offset)
+            if end <= offset:
+                continue
+            task.offset = offset
+            task.end = end
+            task.key = key
+            result.append(task)
+        return result
+
+    def update(self, task):
+        record = self.seen[task.key]
+        record["checksum"] = self.__checksum(task.path, min(record["offset"], self.HEAD_SIZE))
+        self.collected[task.key] = record
+
+    def save(self):
+        for key, record in self.records.items():
+            if key not in self.seen and key not in self.collected and os.path.exists(record["path"]):
+                self.collected[key] = record
+        tmpPath = "%s.tmp" % self.path
+        with open(tmpPath, "w") as stateFile:
+            json.dump(self.collected, stateFile)
+        os.replace(tmpPath, self.path)
+
+    def __checksum(self, path, length):
+        with open(path, 'rb') as infile:
+            return hashlib.sha1(infile.read(length)).hexdigest()
+
+    def __last_line_end(self, path, offset, size):
+        # an unfinished last line of the active log is collected in the next run (or when the file is not changed anymore)
+        if size <= offset:
+            return size
+        with open(path, 'rb') as infile:
+            position = size
+            while position > offset:
+                blockStart = max(offset, position - SPOOL_CHUNK_SIZE)
+                infile.seek(blockStart)
+                index = infile.read(position - blockStart).rfind(b"\n")
+                if index >= 0:
+                    return blockStart + index + 1
+                position = blockStart
+        return size
+
+class DedupCache:
+    """
+    Content-addressed cache of the processed (anonymized) files across collection runs. Entries are keyed by the source
+    path, device, inode, size, modification time and collected byte range, and they point to the sha256 digest of the
+    processed output. With the reuse mode, the processed outputs are stored in the cache folder (objects/<digest>), and
+    unchanged files are copied from there instead of processing them again. With the reference mode, unchanged files are
+    left out of the bundle and only listed (with their digest and the bundle that contains them) in a dedup manifest.
+    Entries (and objects) of files that are not matched in a run are dropped when the cache is saved (with partial,
+    only the entries of the files that are checked in the run are replaced).
+    """
+
+    def __init__(self, folder, fingerprint, bundle, mode, logger, partial=False):
+        if mode not in ("reuse", "reference"):
+            raise ValueError("unsupported dedup mode: %s (use 'reuse' or 'reference')" % mode)
+        self.folder = folder
+        self.objects = os.path.join(folder, "objects")
+        self.index_path = os.path.join(folder, "index.json")
+        self.fingerprint = fingerprint
+        self.bundle = bundle
+        self.mode = mode
+        self.logger = logger
+        self.partial = partial
+        self.lock = threading.Lock()
+        self.paths = set()
+        self.entries = {}
+        self.current = {}
+        self.references = {}
+        os.makedirs(self.objects, exist_ok=True)
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path) as indexFile:
+                    index = json.load(indexFile)
+                if index.get("fingerprint") == fingerprint:
+                    self.entries = index["entries"]
+                else:
+                    logger.debug("processing settings are changed, dedup cache entries are dropped")
+            except (ValueError, KeyError) as error:
+                logger.warning("cannot read dedup cache index '%s', processing every file: %s" % (self.index_path, error))
+
+    def plan(self, tasks):
+        """
+        Set the cached output for the unchanged files (reuse mode), or drop them from the result (reference mode).
+        """
+        result = []
+        for task in tasks:
+            key = self.__key(task)
+            self.paths.add(os.path.abspath(task.path))
+            entry = self.entries.get(key)
+            if entry and task.is_file() and (self.mode == "reference" or os.path.exists(os.path.join(self.objects, entry["digest"]))):
+                self.current[key] = entry
+                if self.mode == "reference":
+                    self.logger.debug("file '%s' is unchanged, it is referenced from bundle '%s'" % (task.path, entry["bundle"]))
+                    self.references[task.dest] = entry
                     continue
-                sortFilesByDate=not "sortFilesByDate" in config["collector"] or bool(config["collector"]["sortFilesByDate"])
-                allfiles=sorted(glob.glob(fileObject["path"]), key=os.path.getmtime) if sortFilesByDate else glob.glob(fileObject["path"])
-                exclude_files=__get_excludes(fileObject["excludes"] if "excludes" in fileObject else [], logger)
-                for file in allfiles:
-                    absFilePath=os.path.abspath(file)
-                    if file in exclude_files:
-                        continue
-                    if __is_file_not_in_date_rage(absFilePath, startTime, endTime, logger):
-                        continue
-                    
-                    logger.debug("process file: %s" % absFilePath)
-                    dest_folder=None
-                    labelInPath=fileObject["label"].lower()
-                    if "skipLabelFromPath" in fileObject and fileObject["skipLabelFromPath"]:
-                        logger.debug("skip label from path")
-                        labelInPath=""
-                    if "folderPrefix" in fileObject:
-                        dest_folder=os.path.join(tmp_folder, fileObject["folderPrefix"], labelInPath)
-                    else:
-                        dest_folder=os.path.join(tmp_folder, labelInPath)
-                    useFullPathPerFile=__get_bool_key("useFullPath", fileObject, True) if "useFullPath" in fileObject else useFullPath
-                    dest=os.path.join(dest_folder, os.path.abspath(file).lstrip(os.sep)) if useFullPathPerFile else os.path.join(dest_folder, os.path.basename(file))
-                    dest_parent=os.path.dirname(dest)
-                    if not os.path.exists(dest_parent):
-                        os.makedirs(dest_parent)
-                    if os.path.isfile(file):
-                        shutil.copy(file, dest)
-                    if "rules" in config["collector"] and config["collector"]["rules"]:
-                        for line in fileinput.input(dest, inplace=1):
-                            for rule in config["collector"]["rules"]:
-                                line = re.sub(rule["pattern"], rule["replacement"], line.rstrip())
-                            print(line)
-                    if processFileScript:
-                        subprocess.call([processFileScript, dest, fileObject["label"]])
-                    if fluentEventProcessor:
-                        fluentEventProcessor.process(fileObject["label"], os.path.abspath(file), dest)
-                    deleteProcessedTempFilesOneByOne=__get_bool_key("deleteProcessedTempFilesOneByOne", config["collector"])
-                    if deleteProcessedTempFilesOneByOne:
-                        os.remove(dest)
-                    
-            processFilesFolderScript=__get_str_key("processFilesFolderScript", config["collector"])
-            if processFilesFolderScript:
-                subprocess.call([processFilesFolderScript, tmp_folder])
-            
-            skip_compress=not __get_bool_key("compress", config["collector"], True)
-            keep_processed_files=not __get_bool_key("deleteProcessedTempFiles", config["collector"], True)
-            if skip_compress:
-                print("skipping file compression")
+                task.cached = os.path.join(self.objects, entry["digest"])
+            task.dedup_key = key
+            result.append(task)
+        return result
+
+    def update(self, task, chunks):
+        """
+        Record the processed output (iterable of binary chunks) of a collected file.
+        """
+        if not task.is_file() or task.cached or task.dedup_key in self.current:
+            return
+        checksum = hashlib.sha256()
+        if self.mode == "reuse":
+            with tempfile.NamedTemporaryFile(dir=self.objects, delete=False) as objectFile:
+                try:
+                    for chunk in chunks:
+                        checksum.update(chunk)
+                        objectFile.write(chunk)
+                except BaseException:
+                    objectFile.close()
+                    os.remove(objectFile.name)
+                    raise
+            digest = checksum.hexdigest()
+            os.chmod(objectFile.name, statmodule.S_IMODE(task.stat.st_mode))
+            os.replace(objectFile.name, os.path.join(self.objects, digest))
+        else:
+            for chunk in chunks:
+                checksum.update(chunk)
+            digest = checksum.hexdigest()
+        with self.lock:
+            self.current[task.dedup_key] = {"digest": digest, "bundle": self.bundle}
+
+    def write_manifest(self, path, base_folder):
+        """
+        Write the files that are left out of the bundle (reference mode) with their digests and bundles.
+        """
+        files = [dict(entry, path=os.path.relpath(dest, base_folder)) for dest, entry in sorted(self.references.items())]
+        with open(path, "w") as manifestFile:
+            json.dump({"bundle": self.bundle, "files": files}, manifestFile, indent=2)
+
+    def save(self):
+        if self.partial:
+            for key, entry in self.entries.items():
+                if key.rsplit(":", 6)[0] not in self.paths and key not in self.current:
+                    self.current[key] = entry
+        digests = set(entry["digest"] for entry in self.current.values())
+        for name in os.listdir(self.objects):
+            if name not in digests:
+                os.remove(os.path.join(self.objects, name))
+        tmpPath = "%s.tmp" % self.index_path
+        with open(tmpPath, "w") as indexFile:
+            json.dump({"fingerprint": self.fingerprint, "entries": self.current}, indexFile)
+        os.replace(tmpPath, self.index_path)
+
+    def __key(self, task):
+        stat = task.stat
+        return "%s:%d:%d:%d:%d:%d:%s" % (os.path.abspath(task.path), stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns,
+                                         task.offset, "" if task.end is None else task.end)
+
+class ParallelCompressWriter:
+    """
+    Write-only file object that splits the written data into chunks and compresses them on a thread pool
+    (zlib and bz2 release the GIL). Compressed chunks are written in order as independent gzip members or
+    bzip2 streams (like pigz / pbzip2), which are readable by any gzip/bzip2 reader.
+    """
+
+    def __init__(self, fileobj, compress, threads, chunk_size=COMPRESS_CHUNK_SIZE):
+        self.fileobj = fileobj
+        self.compress = compress
+        self.chunk_size = chunk_size
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+        self.max_pending = threads * 2
+        self.pending = collections.deque()
+        self.buffer = bytearray()
+        self.position = 0
+
+    def write(self, data):
+        self.buffer += data
+        self.position += len(data)
+        while len(self.buffer) >= self.chunk_size:
+            self.__submit(bytes(self.buffer[:self.chunk_size]))
+            del self.buffer[:self.chunk_size]
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        try:
+            if self.buffer:
+                self.__submit(bytes(self.buffer))
+                self.buffer = bytearray()
+            while self.pending:
+                self.fileobj.write(self.pending.popleft().result())
+        finally:
+            self.executor.shutdown()
+            self.fileobj.close()
+
+    def __submit(self, chunk):
+        self.pending.append(self.executor.submit(self.compress, chunk))
+        while len(self.pending) >= self.max_pending:
+            self.fileobj.write(self.pending.popleft().result())
+
+class ArchiveWriter:
+    """
+    Writes files into a zip/tar/gztar/bztar/zstdtar/lz4tar archive. The archive is written into a '.part' file
+    first and renamed when it is complete. gztar and bztar archives are compressed on more threads if threads > 1,
+    zstdtar and lz4tar need the optional zstandard and lz4 packages.
+    """
+
+    TAR_MODES = {"tar": "w", "gztar": "w:gz", "bztar": "w:bz2"}
+
+    def __init__(self, destination, format, extension, level=None, threads=1):
+        self.path = "%s.%s" % (destination, extension)
+        self.part_path = "%s.part" % self.path
+        self.format = format
+        self.compressor = None
+        # archive and compression modules are loaded only for the used format
+        if format == "zip":
+            import zipfile
+        else:
+            import tarfile
+        if format == "zip":
+            if level is None:
+                self.archive = zipfile.ZipFile(self.part_path, "w", zipfile.ZIP_DEFLATED, allowZip64=True)
             else:
-                extension = "zip"
-                if compressFormat == "tar":
-                    extension = "tar"
-                elif compressFormat == "gztar":
-                    extension = "tar.gz"
-                elif compressFormat == "bztar":
-                    extension = "tar.bz2"
-
-                output_file=os.path.join(outputLocation, zipfile_name)
-                make_archive(tmp_folder, output_file, compressFormat, extension)
-            
-            if keep_processed_files:
-                print("keep processed files in '%s' folder" % os.path.join(outputLocation, "tmp"))
+                self.archive = zipfile.ZipFile(self.part_path, "w", zipfile.ZIP_DEFLATED, allowZip64=True, compresslevel=level)
+        elif format in ("gztar", "bztar") and threads > 1:
+            if format == "gztar":
+                import gzip
+                compress = functools.partial(gzip.compress, compresslevel=9 if level is None else level)
             else:
-                shutil.rmtree(os.path.join(outputLocation, "tmp"))
-            
-            if not skip_compress and outputScript:
-                output_compressed_file="%s.%s" % (output_file, extension)
-                subprocess.call([outputScript, output_compressed_file])
-                deleteCompressedFile=__get_bool_key("deleteCompressedFile", config["collector"])
-                if deleteCompressedFile:
-                   os.remove(output_compressed_file)
-            if fluentEventProcessor:
-                fluentEventProcessor.close()
+                import bz2
+                compress = functools.partial(bz2.compress, compresslevel=9 if level is None else level)
+            self.compressor = ParallelCompressWriter(open(self.part_path, "wb"), compress, threads)
+            self.archive = tarfile.open(fileobj=self.compressor, mode="w|")
+        elif format == "zstdtar":
+            import zstandard
+            rawfile = open(self.part_path, "wb")
+            self.compressor = zstandard.ZstdCompressor(level=3 if level is None else level, threads=threads if threads > 1 else 0).stream_writer(rawfile)
+            self.archive = tarfile.open(fileobj=self.compressor, mode="w|")
+        elif format == "lz4tar":
+            import lz4.frame
+            self.compressor = lz4.frame.open(self.part_path, "wb", compression_level=0 if level is None else level)
+            self.archive = tarfile.open(fileobj=self.compressor, mode="w|")
+        elif format in self.TAR_MODES:
+            if level is None or format == "tar":
+                self.archive = tarfile.open(self.part_path, self.TAR_MODES[format])
+            else:
+                self.archive = tarfile.open(self.part_path, self.TAR_MODES[format], compresslevel=level)
+        else:
+            raise ValueError("unknown archive format '%s'" % format)
 
-def make_archive(source, destination, format, extension):
-    name = os.path.basename(destination)
-    archive_from = os.path.dirname(source)
-    archive_to = os.path.basename(source.strip(os.sep))
-    shutil.make_archive(name, format, archive_from, archive_to)
-    shutil.move("%s.%s" % (name, extension), "%s.%s" % (destination, extension))
+    def add_tree(self, source, arcname):
+        """
+        Add a folder (with its content) to the archive.
+        """
+        if self.format != "zip":
+            self.archive.add(source, arcname)
+            return
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            for name in [root] + [os.path.join(root, file) for file in sorted(files)]:
+                self.archive.write(name, os.path.normpath(os.path.join(arcname, os.path.relpath(name, source))))
+
+    def add(self, source, arcname, content=None):
+        """
+        Add a file to the archive. If content (binary file object) is set, it is written instead of the source file data.
+        """
+        if content is None:
+            if self.format == "zip":
+                self.archive.write(source, arcname)
+            else:
+                self.archive.add(source, arcname, recursive=False)
+        elif self.format == "zip":
+            import zipfile
+            zipInfo = zipfile.ZipInfo.from_file(source, arcname)
+            zipInfo.compress_type = self.archive.compression
+            # ZipFile.open does not apply the compresslevel of the archive to the entries (ZipFile.write does)
+            zipInfo._compresslevel = self.archive.compresslevel
+            with self.archive.open(zipInfo, "w", force_zip64=True) as entry:
+                shutil.copyfileobj(content, entry, SPOOL_CHUNK_SIZE)
+        else:
+            tarInfo = self.archive.gettarinfo(source, arcname)
+            content.seek(0, os.SEEK_END)
+            tarInfo.size = content.tell()
+            content.seek(0)
+            self.archive.addfile(tarInfo, content)
+
+    def size(self):
+        return os.path.getsize(self.part_path if os.path.exists(self.part_path) else self.path)
+
+    def close(self):
+        self.archive.close()
+        if self.compressor:
+            self.compressor.close()
+        os.replace(self.part_path, self.path)
+
+    def abort(self):
+        try:
+            self.archive.close()
+            if self.compressor:
+                self.compressor.close()
+        finally:
+            if os.path.exists(self.part_path):
+                os.remove(self.part_path)
+
+class VolumeWriter:
+    """
+    Writes the archive as numbered volumes (<destination>.001.<extension>, <destination>.002.<extension> ...), every volume is
+    a complete archive. A new volume is started when the current one reaches max_size on disk, so a volume can be larger only
+    by the (compressed) size of its last file. Finished volumes are passed to on_volume while the next one is written.
+    Closing it writes a manifest (<destination>.manifest.json) with the volumes, their sizes, sha256 checksums and files.
+    """
+
+    def __init__(self, destination, format, extension, level=None, threads=1, max_size=1073741824, on_volume=None):
+        self.destination = destination
+        self.format = format
+        self.extension = extension
+        self.level = level
+        self.threads = threads
+        self.max_size = max_size
+        self.on_volume = on_volume
+        self.manifest_path = "%s.manifest.json" % destination
+        self.volumes = []
+        self.current = None
+        self.files = []
+
+    def add_tree(self, source, arcname):
+        """
+        Add the files of a folder to the archive (folders are not added as separate entries).
+        """
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            for file in sorted(files):
+                path = os.path.join(root, file)
+                self.add(path, os.path.normpath(os.path.join(arcname, os.path.relpath(path, source))))
+
+    def add(self, source, arcname, content=None):
+        if self.current is None:
+            self.__open()
+        self.current.add(source, arcname, content)
+        self.files.append(arcname)
+        if self.current.size() >= self.max_size:
+            self.__finish()
+
+    def size(self):
+        return sum(volume["size"] for volume in self.volumes) + (self.current.size() if self.current else 0)
+
+    def close(self):
+        if self.current is None and not self.volumes:
+            self.__open()
+        if self.current is not None:
+            self.__finish()
+        manifest = {"name": os.path.basename(self.destination), "format": self.format, "volumes": self.volumes}
+        with open("%s.part" % self.manifest_path, "w") as manifestFile:
+            json.dump(manifest, manifestFile, indent=2)
+        os.replace("%s.part" % self.manifest_path, self.manifest_path)
+
+    def abort(self):
+        if self.current is not None:
+            self.current.abort()
+            self.current = None
+
+    def __open(self):
+        self.current = ArchiveWriter("%s.%03d" % (self.destination, len(self.volumes) + 1), self.format, self.extension, self.level, self.threads)
+        self.files = []
+
+    def __finish(self):
+        self.current.close()
+        path = self.current.path
+        self.current = None
+        checksum = hashlib.sha256()
+        for chunk in read_chunks(path):
+            checksum.update(chunk)
+        self.volumes.append({"name": os.path.basename(path), "size": os.path.getsize(path), "sha256": checksum.hexdigest(), "files": self.files})
+        if self.on_volume:
+            self.on_volume(path)
+
+class RunMetrics:
+    """
+    Timings and counters of one collection run. Stages that run per file (copy, rules, processFileScript, fluent ...)
+    are summed over the files, so with more workers they can be larger than the wall time of the run.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.time()
+        self.seconds = None
+        self.lock = threading.Lock()
+        self.stages = collections.OrderedDict()
+        self.labels = collections.OrderedDict()
+        self.counters = collections.OrderedDict((name, 0) for name in ["files", "failedFiles", "bytes", "lines", "substitutions"])
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_stage_time(name, time.time() - start)
+
+    def add_stage_time(self, name, seconds):
+        with self.lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_file(self, label, stats):
+        if label not in self.labels:
+            self.labels[label] = {"files": 0, "bytes": 0, "lines": 0, "substitutions": 0, "seconds": 0.0}
+        labelMetrics = self.labels[label]
+        labelMetrics["files"] += 1
+        self.count("files")
+        for key in ["bytes", "lines", "substitutions"]:
+            labelMetrics[key] += stats[key]
+            self.count(key, stats[key])
+        for stage, seconds in stats["stages"].items():
+            labelMetrics["seconds"] += seconds
+            self.add_stage_time(stage, seconds)
+
+    def finish(self):
+        self.seconds = time.time() - self.started
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "started": self.started,
+            "seconds": self.seconds if self.seconds is not None else time.time() - self.started,
+            "stages": self.stages,
+            "labels": self.labels,
+            "counters": self.counters
+        }
+
+    def write_report(self, path):
+        with open(path, "w") as reportFile:
+            json.dump(self.to_dict(), reportFile, indent=2)
+
+    def write_prometheus(self, path):
+        """
+        Write the metrics in Prometheus text format (for the node exporter textfile collector).
+        """
+        report = self.to_dict()
+        lines = [
+            "# HELP filecollector_run_seconds Wall time of the last collection run.",
+            "# TYPE filecollector_run_seconds gauge",
+            "filecollector_run_seconds %s" % report["seconds"],
+            "# HELP filecollector_run_timestamp_seconds Start time of the last collection run.",
+            "# TYPE filecollector_run_timestamp_seconds gauge",
+            "filecollector_run_timestamp_seconds %s" % report["started"],
+            "# HELP filecollector_stage_seconds Time spent in a collection stage during the last run.",
+            "# TYPE filecollector_stage_seconds gauge"
+        ]
+        for stage, seconds in report["stages"].items():
+            lines.append('filecollector_stage_seconds{stage="%s"} %s' % (self.__escape(stage), seconds))
+        for key in ["files", "bytes", "lines", "substitutions", "seconds"]:
+            lines.append("# HELP filecollector_label_%s Collected %s per label during the last run." % (key, key))
+            lines.append("# TYPE filecollector_label_%s gauge" % key)
+            for label, labelMetrics in report["labels"].items():
+                lines.append('filecollector_label_%s{label="%s"} %s' % (key, self.__escape(label), labelMetrics[key]))
+        for name, value in report["counters"].items():
+            metricName = "filecollector_%s" % re.sub(r"([A-Z])", lambda match: "_" + match.group(1).lower(), name)
+            lines.append("# TYPE %s gauge" % metricName)
+            lines.append("%s %s" % (metricName, value))
+        tmpPath = "%s.tmp" % path
+        with open(tmpPath, "w") as metricsFile:
+            metricsFile.write("\n".join(lines) + "\n")
+        os.replace(tmpPath, path)
+
+    def __escape(self, value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
 
 def __get_str_key(key, map, default=None):
     if default:
@@ -215,29 +1832,88 @@ def __setup_logger(config):
     logger.addHandler(consoleHandler)
     return logger
 
-def __get_excludes(paths, logger):
-    exclude_files=[]
+def __get_excludes(paths, fileIndex, logger):
+    exclude_files=set()
     for filepath in paths:
-        files=glob.glob(filepath)
+        files=fileIndex.glob(filepath)
         for file in files:
-            exclude_files.append(file)
+            exclude_files.add(os.path.abspath(file))
             logger.debug("file %s will be excluded from processing." % file)
     return exclude_files
 
-def __disk_check(files, filteredLabels, outputLocation, config, startTime, endTime, logger):
+def __discover_files(files, filteredLabels, tmp_folder, useFullPath, sortFilesByDate, startTime, endTime, logger, paths=None):
+    """
+    Find the files that need to be collected (with one directory scan and one stat per file) and compute their destinations.
+    If paths is set, only those paths are checked against the patterns, without scanning the directories.
+    """
+    fileIndex=FileIndex()
+    tasks=[]
+    for fileObject in files:
+        if filteredLabels and fileObject["label"] not in filteredLabels:
+            continue
+        exclude_files=__get_excludes(fileObject["excludes"] if "excludes" in fileObject else [], fileIndex, logger)
+        allfiles=[]
+        matches=fileIndex.glob(fileObject["path"]) if paths is None else [path for path in paths if FileIndex.match(fileObject["path"], path)]
+        for file in matches:
+            stat=fileIndex.stat(file)
+            if stat is None:
+                logger.debug("skipping file '%s' as it cannot be accessed" % file)
+                continue
+            allfiles.append((file, stat))
+        if sortFilesByDate:
+            allfiles.sort(key=lambda fileWithStat: fileWithStat[1].st_mtime)
+        labelInPath=fileObject["label"].lower()
+        if "skipLabelFromPath" in fileObject and fileObject["skipLabelFromPath"]:
+            logger.debug("skip label from path")
+            labelInPath=""
+        if "folderPrefix" in fileObject:
+            dest_folder=os.path.join(tmp_folder, fileObject["folderPrefix"], labelInPath)
+        else:
+            dest_folder=os.path.join(tmp_folder, labelInPath)
+        useFullPathPerFile=__get_bool_key("useFullPath", fileObject, True) if "useFullPath" in fileObject else useFullPath
+        lineFilter=None
+        if "includeLines" in fileObject or "excludeLines" in fileObject:
+            lineFilter=LineFilter(fileObject.get("includeLines"), fileObject.get("excludeLines"))
+        timestampParser=None
+        if (startTime or endTime) and __get_str_key("timestampPattern", fileObject):
+            timestampParser=TimestampParser(fileObject["timestampPattern"], __get_str_key("timestampFormat", fileObject))
+        regularFiles=[fileWithStat for fileWithStat in allfiles if statmodule.S_ISREG(fileWithStat[1].st_mode)]
+        activeFile=max(regularFiles, key=lambda fileWithStat: fileWithStat[1].st_mtime)[0] if regularFiles else None
+        for file, stat in allfiles:
+            absFilePath=os.path.abspath(file)
+            if absFilePath in exclude_files:
+                continue
+            if __is_file_not_in_date_rage(absFilePath, stat, startTime, endTime, logger):
+                continue
+            dest=os.path.join(dest_folder, absFilePath.lstrip(os.sep)) if useFullPathPerFile else os.path.join(dest_folder, os.path.basename(file))
+            offset, end=0, None
+            if timestampParser and statmodule.S_ISREG(stat.st_mode):
+                timeRange=timestampParser.find_range(file, stat.st_size, startTime, endTime)
+                if timeRange is None:
+                    # the file passed the modification time check, it is collected as a whole
+                    logger.warning("file '%s' has no line that matches 'timestampPattern', collecting the whole file" % file)
+                    timeRange=(0, stat.st_size)
+                offset, end=timeRange
+                if end <= offset:
+                    logger.debug("skipping file '%s' as it has no lines between 'start-time' and 'end-time'" % file)
+                    continue
+                logger.debug("collect bytes %d-%d of file '%s' (based on the line timestamps)" % (offset, end, file))
+                if end >= stat.st_size:
+                    end=None
+            task=CollectedFile(fileObject["label"], file, dest, stat, offset, end)
+            task.line_filter=lineFilter
+            task.active=file == activeFile
+            tasks.append(task)
+    return tasks
+
+def __disk_check(tasks, outputLocation, config, logger):
     checkDiskSpace=__get_bool_key("checkDiskSpace", config, True)
     requiredDiskSpaceRatio=__get_float_key("requiredDiskSpaceRatio", config, 1.0)
     if checkDiskSpace:
         logger.debug("disk space check is enabled")
         fullSize=0
-        for fileObject in files:
-            if filteredLabels and fileObject["label"] not in filteredLabels:
-                continue
-            filePaths=glob.glob(fileObject["path"])
-            for file in filePaths:
-                if __is_file_not_in_date_rage(os.path.abspath(file), startTime, endTime, logger):
-                    continue
-                fullSize = fullSize + os.stat(file).st_size
+        for task in tasks:
+            fullSize = fullSize + task.size()
         freeSpace=0
         requiredFreeSpace=0
         total, used, freeSpace = shutil.disk_usage(outputLocation)
@@ -250,11 +1926,11 @@ def __disk_check(files, filteredLabels, outputLocation, config, startTime, endTi
     else:
         logger.debug("disk space check is disabled")
 
-def __is_file_not_in_date_rage(file_path, start_time, end_time, logger):
+def __is_file_not_in_date_rage(file_path, stat, start_time, end_time, logger):
     result=False
     if start_time or end_time:
-        creationDate=__creation_date(file_path)
-        lastModifiedDate=os.stat(file_path).st_mtime
+        creationDate=__creation_date(stat)
+        lastModifiedDate=stat.st_mtime
         logger.debug("file '%s' creation date: %s." % (file_path, creationDate))
         logger.debug("file '%s' last modification date: %s." % (file_path, lastModifiedDate))
         if start_time and lastModifiedDate < start_time:
@@ -267,28 +1943,419 @@ def __is_file_not_in_date_rage(file_path, start_time, end_time, logger):
             logger.debug("file '%s' is in the right date range (based on creation/last modification datestamps)" % file_path)
     return result
 
-def __creation_date(file_path):
-    if platform.system() == 'Windows':
-        return os.path.getctime(file_path)
+def __creation_date(stat):
+    if os.name == 'nt':
+        return stat.st_ctime
     else:
-        stat = os.stat(file_path)
         try:
             return stat.st_birthtime
         except AttributeError:
             return stat.st_mtime
 
+class TimestampParser:
+    """
+    Reads the timestamps of log lines (first group of the pattern, or the whole match) to find the lines of a time window.
+    Log files are expected to be sorted by time, so the window is found with a binary search on byte offsets (seek, then
+    skip to the next line start) instead of reading the whole file. Lines without a timestamp (like stack traces) belong
+    to the last line before them that has one. Without a format, the timestamp is parsed as epoch seconds.
+    """
+
+    def __init__(self, pattern, format=None):
+        self.pattern = re.compile(pattern.encode("utf-8"))
+        self.format = format
+
+    def parse(self, line):
+        match = self.pattern.search(line)
+        if not match:
+            return None
+        value = (match.group(1) if self.pattern.groups else match.group(0)).decode("utf-8", "replace")
+        try:
+            if self.format:
+                return datetime.datetime.strptime(value, self.format).timestamp()
+            return float(value)
+        except ValueError:
+            return None
+
+    def find_range(self, path, size, start_time=None, end_time=None):
+        """
+        Return the [offset, end) byte range of the file that contains the lines between start_time and end_time,
+        or None if no line of the file has a timestamp.
+        """
+        with open(path, "rb") as infile:
+            if self.__next_timestamp(infile, 0, size)[1] is None:
+                return None
+            offset = self.__first_line_after(infile, size, start_time, False) if start_time else 0
+            end = self.__first_line_after(infile, size, end_time, True) if end_time else size
+        return offset, max(offset, end)
+
+    def __first_line_after(self, infile, size, timestamp, inclusive):
+        # start of the first line with a timestamp larger than (or equal to, if not inclusive) the given one
+        low, high = 0, size
+        while low < high:
+            middle = (low + high) // 2
+            line_start, line_time = self.__next_timestamp(infile, middle, size)
+            if line_time is None or line_time > timestamp or (line_time == timestamp and not inclusive):
+                high = middle
+            else:
+                low = middle + 1
+        return self.__next_timestamp(infile, low, size)[0]
+
+    def __next_timestamp(self, infile, position, size):
+        if position > 0:
+            infile.seek(position - 1)
+            infile.readline()
+        else:
+            infile.seek(0)
+        while True:
+            line_start = infile.tell()
+            if line_start >= size:
+                return size, None
+            line = infile.readline()
+            line_time = self.parse(line)
+            if line_time is not None:
+                return line_start, line_time
+
+class LineFilter:
+    """
+    Keeps the lines that match one of the include patterns (if there are any) and none of the exclude patterns.
+    Patterns without regex special characters are searched as literal substrings in the whole chunk first, so only
+    the lines around their occurrences are looked at; the other patterns are checked line by line with one combined regex.
+    """
+
+    SPECIAL_CHARACTERS = re.compile(r"[\\.^$*+?{}\[\]|()]")
+
+    def __init__(self, include=None, exclude=None):
+        self.include_literals, self.include_regex = self.__compile(include)
+        self.exclude_literals, self.exclude_regex = self.__compile(exclude)
+        self.has_include = bool(self.include_literals or self.include_regex)
+
+    def filter(self, data):
+        """
+        Filter a chunk of whole lines (binary).
+        """
+        if self.has_include:
+            if self.include_regex:
+                data = b"".join(line for line in data.splitlines(True) if self.__matches(line, self.include_literals, self.include_regex))
+            else:
+                data = self.__select(data, self.__literal_spans(data, self.include_literals))
+        if data and self.exclude_regex:
+            data = b"".join(line for line in data.splitlines(True) if not self.__matches(line, self.exclude_literals, self.exclude_regex))
+        elif data and self.exclude_literals:
+            spans = self.__literal_spans(data, self.exclude_literals)
+            if spans:
+                kept = []
+                position = 0
+                for start, end in spans:
+                    kept.append((position, start))
+                    position = end
+                kept.append((position, len(data)))
+                data = self.__select(data, kept)
+        return data
+
+    def __compile(self, patterns):
+        if isinstance(patterns, str):
+            patterns = [patterns]
+        literals = [pattern.encode("utf-8") for pattern in patterns or [] if not self.SPECIAL_CHARACTERS.search(pattern)]
+        expressions = [pattern for pattern in patterns or [] if self.SPECIAL_CHARACTERS.search(pattern)]
+        regex = re.compile("|".join("(?:%s)" % pattern for pattern in expressions).encode("utf-8")) if expressions else None
+        return [literal for literal in literals if literal], regex
+
+    def __matches(self, line, literals, regex):
+        return any(literal in line for literal in literals) or regex.search(line) is not None
+
+    def __literal_spans(self, data, literals):
+        # sorted, merged [start, end) ranges of the lines that contain any of the literals
+        lines = set()
+        for literal in literals:
+            position = data.find(literal)
+            while position >= 0:
+                start = data.rfind(b"\n", 0, position) + 1
+                end = data.find(b"\n", position + len(literal))
+                end = len(data) if end < 0 else end + 1
+                lines.add((start, end))
+                position = data.find(literal, end)
+        return sorted(lines)
+
+    def __select(self, data, spans):
+        return b"".join(data[start:end] for start, end in spans if end > start)
+
+class RuleEngine:
+    """
+    Anonymization rules compiled once per run. Lines are checked against all the patterns
+    in one combined regex first, so only matching lines go through the rules one by one.
+    If the patterns do not depend on the line boundaries (anchors, lookarounds), the patterns are searched in the
+    whole chunk instead, and the lines between the hits are copied as they are, without a Python loop over them.
+    """
+
+    LINE_DEPENDENT = re.compile(r"(?<![\\\[])\^|(?<!\\)\$|\\[AZ]|\(\?<?[=!]")
+
+    def __init__(self, rules, buffer_size=1048576):
+        self.rules = [(re.compile(rule["pattern"]), rule["replacement"]) for rule in rules]
+        self.buffer_size = buffer_size
+        self.matcher = None
+        if len(self.rules) > 1 and not any(re.search(r"\\\d|\(\?P=", rule["pattern"]) for rule in rules):
+            try:
+                self.matcher = re.compile("|".join("(?:%s)" % rule["pattern"] for rule in rules))
+            except re.error:
+                self.matcher = None
+        self.chunk_search = bool(self.rules) and not any(self.LINE_DEPENDENT.search(rule["pattern"]) for rule in rules)
+
+    def apply(self, line):
+        return self.substitute(line)[0]
+
+    def substitute(self, line):
+        """
+        Apply the rules on a line, returns the result and the number of substitutions.
+        """
+        if self.matcher and not self.matcher.search(line):
+            return line, 0
+        return self.__apply_rules(line)
+
+    def __apply_rules(self, line):
+        substitutions = 0
+        for pattern, replacement in self.rules:
+            line, count = pattern.subn(replacement, line)
+            substitutions += count
+        return line, substitutions
+
+    def apply_text(self, text, stats=None):
+        if not self.chunk_search:
+            return self.__apply_lines(text, stats)
+        parts = []
+        substitutions = 0
+        position = 0
+        for start, end in sorted(self.__matching_lines(text).items()):
+            line, count = text[start:end], 0
+            if line.endswith("\r"):
+                line, count = self.__apply_rules(line[:-1])
+                line += "\r"
+            elif line:
+                line, count = self.__apply_rules(line)
+            parts.append(text[position:start])
+            parts.append(line)
+            substitutions += count
+            position = end
+        parts.append(text[position:])
+        if stats is not None:
+            stats["lines"] += text.count("\n") + (1 if text and not text.endswith("\n") else 0)
+            stats["substitutions"] += substitutions
+        return "".join(parts)
+
+    def __matching_lines(self, text):
+        # start -> end of the lines with a match of any pattern; every pattern is searched on its own (that is faster than
+        # the combined regex), and after a hit the search goes on from the next line, so a match that runs over a line
+        # end cannot hide a match in the next line
+        lines = {}
+        for pattern, replacement in self.rules:
+            match = pattern.search(text)
+            while match:
+                start = text.rfind("\n", 0, match.start()) + 1
+                end = text.find("\n", match.start())
+                if end < 0:
+                    lines[start] = len(text)
+                    break
+                lines[start] = end
+                match = pattern.search(text, end + 1)
+        return lines
+
+    def __apply_lines(self, text, stats):
+        lines = text.split("\n")
+        substitutions = 0
+        for index, line in enumerate(lines):
+            if line.endswith("\r"):
+                line, count = self.substitute(line[:-1])
+                lines[index] = line + "\r"
+                substitutions += count
+            elif line:
+                lines[index], count = self.substitute(line)
+                substitutions += count
+        if stats is not None:
+            stats["lines"] += len(lines) - 1 if not lines[-1] else len(lines)
+            stats["substitutions"] += substitutions
+        return "\n".join(lines)
+
+    def chunks(self, source, start=0, end=None, stats=None):
+        """
+        Read the [start, end) byte range of the source file and yield the anonymized content in encoded chunks.
+        Processed bytes, lines and substitutions are counted into stats (if it is set).
+        """
+        for data in read_chunks(source, start, end, self.buffer_size, whole_lines=True):
+            if stats is not None:
+                stats["bytes"] += len(data)
+            yield self.apply_text(data.decode("utf-8", "surrogateescape"), stats).encode("utf-8", "surrogateescape")
+
+    def anonymize(self, source, destination, start=0, end=None, stats=None):
+        with open(destination, 'wb') as outfile:
+            for chunk in self.chunks(source, start, end, stats):
+                outfile.write(chunk)
+
+class ForwardBatchSender:
+    """
+    Sends events to fluentd in PackedForward mode from a background thread.
+    Events are grouped into batches (by tag) that are sent if they reach the batch size or the flush interval.
+    Sent batches go through a bounded queue, so emitting blocks if the network cannot keep up.
+    Failed sends are retried (with reconnect), batches that cannot be sent are logged and counted.
+    """
+
+    def __init__(self, host, port, batch_size=1000, flush_interval=1.0, queue_size=8, retries=3, timeout=3.0, require_ack=False):
+        self.host = host
+        self.port = port
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retries = retries
+        self.timeout = timeout
+        self.require_ack = require_ack
+        self.logger = logging.getLogger('filecollector')
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        self.socket = None
+        self.pending_tag = None
+        self.pending = []
+        self.pending_since = None
+        self.sent_events = 0
+        self.failed_events = 0
+        self.thread = threading.Thread(target=self.__run, name="filecollector-fluent-sender")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def emit_many(self, tag, entries):
+        """
+        Add (time, record) entries for a tag to the current batch.
+        """
+        with self.lock:
+            if self.pending and tag != self.pending_tag:
+                self.__enqueue((self.pending_tag, self.pending))
+                self.pending = []
+            if not self.pending:
+                self.pending_tag = tag
+                self.pending_since = time.time()
+            self.pending.extend(entries)
+            while len(self.pending) >= self.batch_size:
+                self.__enqueue((tag, self.pending[:self.batch_size]))
+                self.pending = self.pending[self.batch_size:]
+                self.pending_since = time.time()
+
+    def flush(self):
+        with self.lock:
+            if self.pending:
+                self.__enqueue((self.pending_tag, self.pending))
+                self.pending = []
+
+    def close(self):
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+        self.__disconnect()
+        if self.failed_events:
+            self.logger.error("%d event(s) could not be sent to fluentd (%s:%d), %d event(s) sent" % (self.failed_events, self.host, self.port, self.sent_events))
+        else:
+            self.logger.debug("%d event(s) sent to fluentd (%s:%d)" % (self.sent_events, self.host, self.port))
+        return self.failed_events
+
+    def __enqueue(self, batch):
+        # called with the lock held, so the sender thread does not send a newer pending batch before the queued ones
+        if not self.thread.is_alive():
+            raise RuntimeError("fluentd sender thread is not running")
+        self.queue.put(batch)
+
+    def __take_stale_batch(self):
+        # a producer may hold the lock while it waits for a free queue slot, the queue is drained instead of waiting for it
+        if not self.lock.acquire(blocking=False):
+            return None
+        try:
+            if not self.pending or not self.queue.empty() or time.time() - self.pending_since < self.flush_interval:
+                return None
+            batch = (self.pending_tag, self.pending)
+            self.pending = []
+            return batch
+        finally:
+            self.lock.release()
+
+    def __run(self):
+        while True:
+            try:
+                batch = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                batch = self.__take_stale_batch()
+                if not batch:
+                    continue
+            if batch is None:
+                break
+            try:
+                self.__send(*batch)
+            except Exception as error:
+                self.logger.error("dropping %d event(s) with tag '%s': %s" % (len(batch[1]), batch[0], error))
+                self.failed_events += len(batch[1])
+
+    def __send(self, tag, entries):
+        import msgpack
+        packer = msgpack.Packer(use_bin_type=True)
+        events = b"".join([packer.pack(entry) for entry in entries])
+        option = {"size": len(entries)}
+        if self.require_ack:
+            option["chunk"] = base64.b64encode(os.urandom(16)).decode()
+        payload = packer.pack([tag, events, option])
+        for attempt in range(self.retries + 1):
+            try:
+                self.__connect()
+                self.socket.sendall(payload)
+                if self.require_ack:
+                    self.__wait_for_ack(option["chunk"])
+                self.sent_events += len(entries)
+                return
+            except (OSError, ValueError) as error:
+                self.__disconnect()
+                if attempt < self.retries:
+                    self.logger.warning("sending %d event(s) to fluentd failed (attempt %d of %d): %s" % (len(entries), attempt + 1, self.retries + 1, error))
+                    time.sleep(min(0.5 * (2 ** attempt), 10))
+                else:
+                    self.logger.error("dropping %d event(s) with tag '%s' as sending to fluentd failed: %s" % (len(entries), tag, error))
+        self.failed_events += len(entries)
+
+    def __wait_for_ack(self, chunk):
+        import msgpack
+        unpacker = msgpack.Unpacker(raw=False)
+        while True:
+            data = self.socket.recv(4096)
+            if not data:
+                raise OSError("connection closed before ack")
+            unpacker.feed(data)
+            for response in unpacker:
+                if isinstance(response, dict) and response.get("ack") == chunk:
+                    return
+                raise ValueError("unexpected ack response: %s" % response)
+
+    def __connect(self):
+        if not self.socket:
+            self.socket = socket.create_connection((self.host, self.port), timeout=self.timeout)
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def __disconnect(self):
+        if self.socket:
+            try:
+                self.socket.close()
+            finally:
+                self.socket = None
+
 class EventProcessor:
     
-    def __init__(self, host, port, base_tag, identifier, message_field="message", include_time=False):
+    def __init__(self, host, port, base_tag, identifier, message_field="message", include_time=False, batch_size=0,
+                 flush_interval=1.0, queue_size=8, retries=3, timeout=3.0, require_ack=False):
         self.host = host
         self.port = port
         self.base_tag = base_tag
         self.identifier = identifier
         self.message_field = message_field
         self.include_time = include_time
-        if host and port:
+        self.fluentSender = None
+        self.batchSender = None
+        if batch_size > 0:
+            self.batchSender = ForwardBatchSender(host or "localhost", port or 24224, batch_size, flush_interval, queue_size, retries, timeout, require_ack)
+        elif host and port:
+            from fluent import sender
             self.fluentSender = sender.FluentSender(base_tag, host=host, port=port)
         else:
+            from fluent import sender
             self.fluentSender = sender.FluentSender(base_tag)
 
     def process(self, name, path, real_path):
@@ -296,16 +2363,35 @@ class EventProcessor:
             if "*" in name:
                 replaced_path=path.replace(os.sep, ".")
                 name=name.replace("*", replaced_path)
+            lineCount = 0
+            size = 0
+            if self.batchSender:
+                tag = "%s.%s" % (self.base_tag, name) if self.base_tag else name
+                while True:
+                    lines = infile.readlines(100000)
+                    if not lines:
+                        break
+                    timestamp = time.time() if self.include_time else int(time.time())
+                    self.batchSender.emit_many(tag, [(timestamp, {self.message_field: line}) for line in lines])
+                    lineCount += len(lines)
+                    size += sum(len(line) for line in lines)
+                return lineCount, size
             for line in infile:
                 if self.include_time:
                     self.fluentSender.emit_with_time(name, time.time(), {self.message_field: line})
                 else:
                     self.fluentSender.emit(name, {self.message_field: line})
+                lineCount += 1
+                size += len(line)
+            return lineCount, size
 
     def close(self):
+        if self.batchSender:
+            return self.batchSender.close()
         self.fluentSender.close()
 
 if __name__ == "__main__":
+    from pid import PidFile
     pidfile=os.environ.get('FILECOLLECTOR_PIDFILE', 'filecollector-collector.pid')
     with PidFile(pidfile) as p:
         main(sys.argv[1:])
\ No newline at end of file
@@ -21,8 +21,22 @@
 import argparse
 import sys
 import os
+import re
+import json
+import posixpath
+import threading
+import email.utils
+import http.server
+import socketserver
+import urllib.parse
+import logging
+import tarfile
+import tempfile
 import yaml
 from pid import PidFile
+from filecollector import collector
+
+SPOOL_MAX_SIZE = 16 * 1048576
 
 def parse_args(args):
     parser = argparse.ArgumentParser(
@@ -39,25 +53,326 @@ def main(args):
         if config and "server" in config:
             port = int(config["server"]["port"])
             folder = str(config["server"]["folder"])
+            web_dir = os.getcwd()
             if folder:
                 web_dir = os.path.join(os.path.dirname(__file__), folder)
-                os.chdir(web_dir)
+            threaded = bool(config["server"]["threaded"]) if "threaded" in config["server"] else True
+            streaming = bool(config["server"]["streamEndpoint"]) if "streamEndpoint" in config["server"] else False
+            if streaming and "collector" not in config:
+                raise ValueError("'streamEndpoint' needs the 'collector' configuration block")
+            httpd = create_server(port, web_dir, threaded, collector_config=config if streaming else None)
+            print("serving at port", port)
+            httpd.serve_forever()
+
+def create_server(port, folder, threaded=True, host="", collector_config=None):
+    """
+    Create an HTTP server for the collected files in folder. With threaded, every connection is handled in its own thread.
+    If collector_config is set, the matched files of the collector can be streamed on demand (/stream). The hostname
+    of the streamed archives ('collector.hostname' or the FQDN of the host) is resolved once here, not per request.
+    """
+    stream_hostname = None
+    if collector_config:
+        stream_hostname = collector_config["collector"].get("hostname") or collector.get_hostname()
+    handler = type("FolderRequestHandler", (ArchiveRequestHandler,), {
+        "serve_directory": os.path.abspath(folder),
+        "bundle_index": BundleIndex(os.path.abspath(folder)),
+        "collector_config": collector_config,
+        "stream_hostname": stream_hostname
+    })
+    if threaded:
+        return ThreadingHTTPServer((host, port), handler)
+    return http.server.HTTPServer((host, port), handler)
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class BundleIndex:
+    """
+    JSON index of the files (collected bundles) in the root of the served folder. It is cached and
+    built again only if the folder changes (based on its modification time).
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.lock = threading.Lock()
+        self.version = None
+        self.content = None
+        self.etag = None
+
+    def get(self):
+        version = os.stat(self.folder).st_mtime_ns
+        with self.lock:
+            if version != self.version:
+                bundles = []
+                for entry in sorted(os.scandir(self.folder), key=lambda entry: entry.name):
+                    if entry.name.startswith(".") or entry.name.endswith(".part") or not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                    bundles.append({"name": entry.name, "size": stat.st_size, "mtime": stat.st_mtime, "etag": file_etag(stat)})
+                self.content = json.dumps({"bundles": bundles}).encode("utf-8")
+                self.etag = '"index-%x-%x"' % (version, len(self.content))
+                self.version = version
+            return self.content, self.etag
+
+class ChunkedWriter:
+    """
+    File-like object that writes the data into an HTTP/1.1 chunked response.
+    """
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+
+    def write(self, data):
+        if data:
+            self.wfile.write(b"%x\r\n" % len(data) + data + b"\r\n")
+        return len(data)
+
+    def flush(self):
+        self.wfile.flush()
+
+    def close(self):
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+def file_etag(stat):
+    return '"%x-%x-%x"' % (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+class ArchiveRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """
+    File server handler with HTTP/1.1 keep-alive, single range requests (resumable downloads), ETag and
+    Last-Modified conditional requests, sendfile based transfer and a cached JSON index of the bundles (/index.json).
+    If collector_config is set, /stream runs the discovery and the rules of the collector, and streams the result
+    (tar.gz or NDJSON) with chunked transfer encoding, without writing it to disk.
+    """
+
+    protocol_version = "HTTP/1.1"
+    serve_directory = None
+    bundle_index = None
+    collector_config = None
+    stream_hostname = None
+    index_path = "/index.json"
+    stream_path = "/stream"
+
+    def do_GET(self):
+        self.__handle(True)
+
+    def do_HEAD(self):
+        self.__handle(False)
+
+    def translate_path(self, path):
+        path = urllib.parse.unquote(path.split("?", 1)[0].split("#", 1)[0])
+        trailing_slash = path.rstrip().endswith("/")
+        result = self.serve_directory
+        for word in filter(None, posixpath.normpath(path).split("/")):
+            if os.path.dirname(word) or word in (os.curdir, os.pardir):
+                continue
+            result = os.path.join(result, word)
+        if trailing_slash:
+            result += "/"
+        return result
+
+    def __handle(self, send_body):
+        if self.collector_config and self.path.split("?", 1)[0] == self.stream_path:
+            self.__stream(send_body)
+            return
+        if self.bundle_index and self.path.split("?", 1)[0] == self.index_path:
+            content, etag = self.bundle_index.get()
+            if self.__etag_matches(etag):
+                self.__send_not_modified(etag, None)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(content)))
+            self.send_header("ETag", etag)
+            self.end_headers()
+            if send_body:
+                self.wfile.write(content)
+            return
+        path = self.translate_path(self.path)
+        if os.path.isdir(path):
+            f = super().send_head()
+            if f:
+                try:
+                    if send_body:
+                        self.copyfile(f, self.wfile)
+                finally:
+                    f.close()
+            return
+        try:
+            f = open(path, "rb")
+        except OSError:
+            self.send_error(404, "File not found")
+            return
+        try:
+            self.__send_file(f, send_body)
+        finally:
+            f.close()
+
+    def __send_file(self, f, send_body):
+        stat = os.fstat(f.fileno())
+        etag = file_etag(stat)
+        last_modified = self.date_time_string(stat.st_mtime)
+        if self.__etag_matches(etag) or ("If-None-Match" not in self.headers and self.__not_modified_since(stat.st_mtime)):
+            self.__send_not_modified(etag, last_modified)
+            return
+        size = stat.st_size
+        byte_range = self.__parse_range(size, etag, last_modified)
+        if byte_range == "unsatisfiable":
+            self.send_response(416)
+            self.send_header("Content-Range", "bytes */%d" % size)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if byte_range:
+            start, end = byte_range
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end, size))
+        else:
+            start, end = 0, size - 1
+            self.send_response(200)
+        self.send_header("Content-Type", self.guess_type(self.translate_path(self.path)))
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", last_modified)
+        self.end_headers()
+        if send_body and end >= start:
+            self.wfile.flush()
             try:
-                import http.server
-                import socketserver
-                handler = http.server.SimpleHTTPRequestHandler
-                httpd = socketserver.TCPServer(("", port), handler)
-                print("serving at port", port)
-                httpd.serve_forever()
-            except ImportError as error:
-                import SimpleHTTPServer
-                import SocketServer
-                Handler = SimpleHTTPServer.SimpleHTTPRequestHandler
-                httpd = SocketServer.TCPServer(("", port), Handler)
-                print ("serving at port", port)
-                httpd.serve_forever()
+                self.connection.sendfile(f, start, end - start + 1)
+            except (AttributeError, OSError):
+                f.seek(start)
+                remaining = end - start + 1
+                while remaining > 0:
+                    data = f.read(min(remaining, 1048576))
+                    if not data:
+                        break
+                    self.wfile.write(data)
+                    remaining -= len(data)
+
+    def __stream(self, send_body):
+        """
+        Stream the collected files. Query parameters: labels (comma separated), start and end (epoch seconds),
+        grep (regex, can be repeated, lines that match any of them are kept) and format (tar.gz or ndjson).
+        """
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        labels = [label for value in query.get("labels", []) for label in value.split(",") if label]
+        output_format = query.get("format", ["tar.gz"])[-1]
+        try:
+            start_time = float(query["start"][-1]) if "start" in query else None
+            end_time = float(query["end"][-1]) if "end" in query else None
+            grep = query.get("grep")
+            for pattern in grep or []:
+                re.compile(pattern)
+            if output_format not in ("tar.gz", "ndjson"):
+                raise ValueError("unsupported format: %s (use 'tar.gz' or 'ndjson')" % output_format)
+        except (ValueError, re.error) as error:
+            self.send_error(400, "Bad stream request: %s" % error)
+            return
+        logger = logging.getLogger('filecollector')
+        files = collector.stream_files(self.collector_config, labels, start_time, end_time, logger, grep, self.stream_hostname)
+        self.send_response(200)
+        if output_format == "ndjson":
+            self.send_header("Content-Type", "application/x-ndjson")
+        else:
+            self.send_header("Content-Type", "application/gzip")
+            self.send_header("Content-Disposition", 'attachment; filename="stream.tar.gz"')
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        if not send_body:
+            return
+        writer = ChunkedWriter(self.wfile)
+        try:
+            if output_format == "ndjson":
+                self.__write_ndjson(files, writer)
+            else:
+                self.__write_tar(files, writer, bool(grep))
+            writer.close()
+        except Exception as error:
+            # the status is sent already, closing the connection without the last chunk marks the response as incomplete
+            logger.error("streaming collected files failed: %s" % error)
+            self.close_connection = True
+
+    def __write_ndjson(self, files, writer):
+        for task, arcname, chunks in files:
+            path = os.path.abspath(task.path)
+            for data in chunks if chunks is not None else collector.read_chunks(task.path, task.offset, task.end, whole_lines=True):
+                lines = [json.dumps({"label": task.label, "path": path, "line": line.decode("utf-8", "replace")})
+                         for line in data.splitlines()]
+                writer.write(("\n".join(lines) + "\n").encode("utf-8"))
+
+    def __write_tar(self, files, writer, skip_empty):
+        with tarfile.open(fileobj=writer, mode="w|gz") as archive:
+            for task, arcname, chunks in files:
+                tarInfo = archive.gettarinfo(task.path, arcname)
+                if chunks is None:
+                    tarInfo.size = task.size()
+                    with open(task.path, "rb") as content:
+                        content.seek(task.offset)
+                        archive.addfile(tarInfo, content)
+                    continue
+                with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as content:
+                    for data in chunks:
+                        content.write(data)
+                    tarInfo.size = content.tell()
+                    if skip_empty and not tarInfo.size:
+                        continue
+                    content.seek(0)
+                    archive.addfile(tarInfo, content)
+
+    def __parse_range(self, size, etag, last_modified):
+        """
+        Parse a single byte range (bytes=start-end, bytes=start-, bytes=-suffix). Multiple ranges and ranges
+        that are not valid for the current version of the file (If-Range) are ignored (full response).
+        """
+        header = self.headers.get("Range")
+        if not header:
+            return None
+        if_range = self.headers.get("If-Range")
+        if if_range and if_range.strip() not in (etag, last_modified):
+            return None
+        match = re.match(r"^\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*$", header)
+        if not match or (not match.group(1) and not match.group(2)):
+            return None
+        if not match.group(1):
+            suffix = int(match.group(2))
+            if suffix == 0:
+                return "unsatisfiable"
+            return max(0, size - suffix), size - 1
+        start = int(match.group(1))
+        end = int(match.group(2)) if match.group(2) else size - 1
+        if start >= size or end < start:
+            return "unsatisfiable"
+        return start, min(end, size - 1)
+
+    def __etag_matches(self, etag):
+        header = self.headers.get("If-None-Match")
+        if not header:
+            return False
+        tags = [tag.strip() for tag in header.split(",")]
+        return "*" in tags or etag in tags or ("W/" + etag) in tags
+
+    def __not_modified_since(self, mtime):
+        header = self.headers.get("If-Modified-Since")
+        if not header:
+            return False
+        try:
+            since = email.utils.parsedate_to_datetime(header)
+        except (TypeError, ValueError, IndexError, OverflowError):
+            return False
+        if since is None:
+            return False
+        return int(mtime) <= since.timestamp()
+
+    def __send_not_modified(self, etag, last_modified):
+        self.send_response(304)
+        self.send_header("ETag", etag)
+        if last_modified:
+            self.send_header("Last-Modified", last_modified)
+        self.end_headers()
 
 if __name__ == "__main__":
     pidfile=os.environ.get('FILECOLLECTOR_PIDFILE', 'filecollector-server.pid')
     with PidFile(pidfile) as p:
-        main(sys.argv[1:])
\ No newline at end of file
+        main(sys.argv[1:])
@@ -45,12 +45,13 @@ setup(
     url="https://github.com/oleewere/filecollector",
     scripts=["bin/filecollector"],
     packages=setuptools.find_packages(),
-    install_requires=['PyYAML>=5.3.1', 'pid>=3.0.3', 'fluent-logger>=0.9.6'],
+    install_requires=['PyYAML>=5.3.1', 'pid>=3.0.3', 'fluent-logger>=0.9.6', 'msgpack>=0.6.0'],
+    extras_require={'zstd': ['zstandard>=0.15.0'], 'lz4': ['lz4>=3.0.0']},
     license='Apache 2.0',
     classifiers=[
         "Programming Language :: Python",
         "Programming Language :: Python :: 3",
         "Operating System :: OS Independent",
     ],
-    python_requires='>=3.5',
+    python_requires='>=3.7',
 )
\ No newline at end of file
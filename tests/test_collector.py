@@ -1,15 +1,125 @@
 import unittest
 import os
+import sys
+import shutil
+import tempfile
+import tarfile
+import zipfile
+import yaml
+import socket
+import threading
+import msgpack
+import glob
+import gzip
+import io
+import json
+import time
+import logging
+import re
+import datetime
 from filecollector import collector
 try:
-    from unittest.mock import MagicMock
+    from unittest.mock import MagicMock, patch
 except ImportError as error:
-    from mock import MagicMock
+    from mock import MagicMock, patch
 
 script_dir=os.path.dirname(os.path.abspath(__file__))
 
+def create_files(folder, count, lines=10):
+    for i in range(count):
+        with open(os.path.join(folder, "app-%d.log" % i), "w") as f:
+            for j in range(lines):
+                f.write("line %d of file %d card: 1234-5678-9012-3456\n" % (j, i))
+
+def run_collector(work_dir, collector_config):
+    config_file=os.path.join(work_dir, "filecollector.yaml")
+    with open(config_file, "w") as f:
+        yaml.dump({"collector": collector_config}, f)
+    collector.main(["--config", config_file])
+
+def read_archive(output_location):
+    result={}
+    for name in os.listdir(output_location):
+        path=os.path.join(output_location, name)
+        if name.endswith(".zip"):
+            with zipfile.ZipFile(path) as archive:
+                for entry in archive.namelist():
+                    if not entry.endswith("/"):
+                        result[entry.split("/", 1)[1]]=archive.read(entry).decode()
+        elif name.endswith(".tar.gz"):
+            with tarfile.open(path) as archive:
+                for entry in archive.getmembers():
+                    if entry.isfile():
+                        result[entry.name.split("/", 1)[1]]=archive.extractfile(entry).read().decode()
+    return result
+
+def read_collected_files(output_location):
+    result={}
+    for root, dirs, files in os.walk(os.path.join(output_location, "tmp")):
+        for file in files:
+            with open(os.path.join(root, file)) as f:
+                result[file]=f.read()
+    return result
+
+class FluentStub:
+    """
+    Minimal forward protocol server on localhost, collects the received (tag, record) pairs.
+    """
+
+    def __init__(self):
+        self.events=[]
+        self.server=socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen(1)
+        self.port=self.server.getsockname()[1]
+        self.thread=threading.Thread(target=self.serve)
+        self.thread.start()
+
+    def serve(self):
+        connection, address=self.server.accept()
+        unpacker=msgpack.Unpacker(raw=False)
+        while True:
+            data=connection.recv(65536)
+            if not data:
+                break
+            unpacker.feed(data)
+            for message in unpacker:
+                tag, entries, option=message
+                events=msgpack.Unpacker(raw=False)
+                events.feed(entries)
+                for timestamp, record in events:
+                    self.events.append((tag, record))
+                if "chunk" in option:
+                    connection.sendall(msgpack.packb({"ack": option["chunk"]}))
+        connection.close()
+
+    def stop(self):
+        self.thread.join()
+        self.server.close()
+
 class TestCollector(unittest.TestCase):
 
+    def setUp(self):
+        self.work_dir=tempfile.mkdtemp()
+        self.input_dir=os.path.join(self.work_dir, "input")
+        self.output_dir=os.path.join(self.work_dir, "output")
+        os.makedirs(self.input_dir)
+        os.makedirs(self.output_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def collector_config(self, **kwargs):
+        config={
+            "files": [{"path": os.path.join(self.input_dir, "*.log"), "label": "app"}],
+            "rules": [{"pattern": r"\d{4}[^\w]\d{4}[^\w]\d{4}[^\w]\d{4}", "replacement": "[REDACTED]"}],
+            "outputLocation": self.output_dir,
+            "compress": False,
+            "deleteProcessedTempFiles": False
+        }
+        config.update(kwargs)
+        return config
+
     def test_empty_collector(self):
         try:
             collector.main(["--config", os.path.join(script_dir, "files/empty_collector.yaml")])
@@ -17,6 +127,567 @@ class TestCollector(unittest.TestCase):
         except Exception: 
             self.assertTrue(True)
 
+    def test_parallel_workers_produce_same_output(self):
+        create_files(self.input_dir, 12)
+        run_collector(self.work_dir, self.collector_config())
+        sequential=read_collected_files(self.output_dir)
+        for workerType in ["thread", "process"]:
+            shutil.rmtree(os.path.join(self.output_dir, "tmp"))
+            run_collector(self.work_dir, self.collector_config(workers=3, workerType=workerType, maxFilesInFlight=4))
+            self.assertEqual(sequential, read_collected_files(self.output_dir))
+        self.assertEqual(12, len(sequential))
+        self.assertNotIn("1234-5678", sequential["app-0.log"])
+
+    def test_rule_engine_keeps_line_endings(self):
+        source=os.path.join(self.input_dir, "source.log")
+        dest=os.path.join(self.output_dir, "dest.log")
+        with open(source, "wb") as f:
+            f.write(b"user=admin pass=secret  \r\nnothing here\nuser=root")
+        engine=collector.RuleEngine([{"pattern": r"pass=\w+", "replacement": "pass=***"},
+                                     {"pattern": r"user=(\w+)", "replacement": r"user=<\1>"}])
+        engine.anonymize(source, dest)
+        with open(dest, "rb") as f:
+            self.assertEqual(b"user=<admin> pass=***  \r\nnothing here\nuser=<root>", f.read())
+
+    def test_rule_engine_searches_whole_chunks(self):
+        text="card 1234\n5678-9012-3456 1234-5678-9012-3456\nip 10.0.0.1\r\n\nnothing\nlast 1234 5678 9012 3456"
+        for rules, chunk_search in [([{"pattern": r"\d{4}[^\w]\d{4}[^\w]\d{4}[^\w]\d{4}", "replacement": "[CARD]"}], True),
+                                    ([{"pattern": r"\d+\.\d+\.\d+\.\d+", "replacement": "[IP]"}, {"pattern": r"\s\d{4}", "replacement": " [N]"}], True),
+                                    ([{"pattern": r"^\w+", "replacement": "[FIRST]"}], False)]:
+            engine=collector.RuleEngine(rules)
+            self.assertEqual(chunk_search, engine.chunk_search)
+            expected, stats="", {"lines": 0, "substitutions": 0}
+            for line in text.splitlines(True):
+                ending=line[len(line.rstrip("\r\n")):]
+                result, count=engine.substitute(line.rstrip("\r\n"))
+                expected+=result + ending
+                stats["substitutions"]+=count
+            result={"lines": 0, "substitutions": 0}
+            self.assertEqual(expected, engine.apply_text(text, result))
+            self.assertEqual(dict(stats, lines=6), result)
+
+    def test_stream_archive_matches_staged_archive(self):
+        create_files(self.input_dir, 3)
+        for compressFormat in ["zip", "gztar"]:
+            run_collector(self.work_dir, self.collector_config(compress=True, compressFormat=compressFormat, deleteProcessedTempFiles=True))
+            staged=read_archive(self.output_dir)
+            shutil.rmtree(self.output_dir)
+            os.makedirs(self.output_dir)
+            run_collector(self.work_dir, self.collector_config(compress=True, compressFormat=compressFormat, streamArchive=True, workers=2))
+            self.assertFalse(os.path.exists(os.path.join(self.output_dir, "tmp")))
+            self.assertEqual(staged, read_archive(self.output_dir))
+            self.assertEqual(3, len(staged))
+            shutil.rmtree(self.output_dir)
+            os.makedirs(self.output_dir)
+
+    def test_incremental_collection_ships_only_new_data(self):
+        log_file=os.path.join(self.input_dir, "app.log")
+        def collect():
+            tmp_dir=os.path.join(self.output_dir, "tmp")
+            if os.path.exists(tmp_dir):
+                shutil.rmtree(tmp_dir)
+            run_collector(self.work_dir, self.collector_config(incremental=True, useFullPath=False, rules=[], files=[{"path": log_file + "*", "label": "app"}]))
+            return read_collected_files(self.output_dir)
+        with open(log_file, "w") as f:
+            f.write("first\nsecond\n")
+        self.assertEqual({"app.log": "first\nsecond\n"}, collect())
+        self.assertEqual({}, collect())
+        with open(log_file, "a") as f:
+            f.write("third\nfourth without end")
+        self.assertEqual({"app.log": "third\n"}, collect())
+        os.rename(log_file, log_file + ".1")
+        with open(log_file, "w") as f:
+            f.write("new\n")
+        self.assertEqual({"app.log": "new\n", "app.log.1": "fourth without end"}, collect())
+        with open(log_file, "w") as f:
+            f.write("x\n")
+        self.assertEqual({"app.log": "x\n"}, collect())
+
+    def test_incremental_collection_ships_files_without_line_end(self):
+        log_file=os.path.join(self.input_dir, "app.log")
+        def collect():
+            shutil.rmtree(os.path.join(self.output_dir, "tmp"), ignore_errors=True)
+            run_collector(self.work_dir, self.collector_config(incremental=True, useFullPath=False, rules=[], files=[{"path": log_file + "*", "label": "app"}]))
+            return read_collected_files(self.output_dir)
+        with open(log_file + ".2", "w") as f:
+            f.write("rotated\nwithout end")
+        os.utime(log_file + ".2", (time.time() - 60, time.time() - 60))
+        with open(log_file, "w") as f:
+            f.write("first\nunfinished")
+        self.assertEqual({"app.log": "first\n", "app.log.2": "rotated\nwithout end"}, collect())
+        self.assertEqual({"app.log": "unfinished"}, collect())
+        self.assertEqual({}, collect())
+        with open(log_file, "a") as f:
+            f.write(" line")
+        self.assertEqual({"app.log": " line"}, collect())
+
+    def test_incremental_collection_with_label_filter(self):
+        files=[{"path": os.path.join(self.input_dir, "a.log"), "label": "A"}, {"path": os.path.join(self.input_dir, "b.log"), "label": "B"}]
+        config={"collector": self.collector_config(incremental=True, useFullPath=False, rules=[], files=files)}
+        def collect(label):
+            shutil.rmtree(os.path.join(self.output_dir, "tmp"), ignore_errors=True)
+            collector.collect(config, [label], None, None, logging.getLogger("filecollector"), hostname="test")
+            return read_collected_files(self.output_dir)
+        for name in ["a.log", "b.log"]:
+            with open(os.path.join(self.input_dir, name), "w") as f:
+                f.write("%s line\n" % name)
+        self.assertEqual({"a.log": "a.log line\n"}, collect("A"))
+        self.assertEqual({"b.log": "b.log line\n"}, collect("B"))
+        self.assertEqual({}, collect("A"))
+        with open(os.path.join(self.input_dir, "b.log"), "a") as f:
+            f.write("new line\n")
+        self.assertEqual({"b.log": "new line\n"}, collect("B"))
+        os.remove(os.path.join(self.input_dir, "a.log"))
+        collect("B")
+        with open(os.path.join(self.output_dir, ".filecollector-state.json")) as f:
+            self.assertEqual([os.path.join(self.input_dir, "b.log")], [record["path"] for record in json.load(f).values()])
+
+    def test_incremental_collection_with_time_window(self):
+        log_file=os.path.join(self.input_dir, "app.log")
+        files=[{"path": log_file, "label": "app", "useFullPath": False, "timestampPattern": r"^(\d+) "}]
+        config={"collector": self.collector_config(incremental=True, rules=[], files=files)}
+        def collect(start_time=None, end_time=None):
+            shutil.rmtree(os.path.join(self.output_dir, "tmp"), ignore_errors=True)
+            collector.collect(config, [], start_time, end_time, logging.getLogger("filecollector"), hostname="test")
+            return read_collected_files(self.output_dir)
+        with open(log_file, "w") as f:
+            for i in range(10):
+                f.write("%d line %d\n" % (1000 + i, i))
+        os.utime(log_file, (1004, 1004))
+        self.assertEqual({"app.log": "".join("%d line %d\n" % (1000 + i, i) for i in range(5))}, collect(end_time=1004))
+        with open(log_file, "a") as f:
+            f.write("1010 line 10\n")
+        self.assertEqual({"app.log": "".join("%d line %d\n" % (1000 + i, i) for i in range(5, 11))}, collect())
+
+    def test_disk_check_uses_collected_ranges(self):
+        log_file=os.path.join(self.input_dir, "app.log")
+        with open(log_file, "w") as f:
+            f.write("old line\n" * 1000)
+        config={"collector": self.collector_config(incremental=True, rules=[])}
+        logger=logging.getLogger("filecollector")
+        collector.collect(config, [], None, None, logger, hostname="first")
+        with open(log_file, "a") as f:
+            f.write("new line\n")
+        with patch("shutil.disk_usage", return_value=(1000, 900, 100)):
+            collector.collect(config, [], None, None, logger, hostname="second")
+            with open(log_file, "a") as f:
+                f.write("new line\n" * 100)
+            self.assertRaises(SystemExit, collector.collect, config, [], None, None, logger, hostname="third")
+        with open(glob.glob(os.path.join(self.output_dir, "tmp", "*-second", "app", "**", "app.log"), recursive=True)[0]) as f:
+            self.assertEqual("new line\n", f.read())
+
+    def test_batched_fluent_forwarding(self):
+        create_files(self.input_dir, 1, lines=10)
+        log_file=os.path.join(self.input_dir, "app-0.log")
+        stub=FluentStub()
+        processor=collector.EventProcessor("127.0.0.1", stub.port, "example", None, batch_size=3, require_ack=True)
+        processor.process("app", log_file, log_file)
+        self.assertEqual(0, processor.close())
+        stub.stop()
+        self.assertEqual(10, len(stub.events))
+        self.assertEqual(("example.app", {"message": "line 9 of file 0 card: 1234-5678-9012-3456\n"}), stub.events[-1])
+
+    def test_fluent_sender_with_full_queue(self):
+        for attempt in range(3):
+            stub=FluentStub()
+            sender=collector.ForwardBatchSender("127.0.0.1", stub.port, batch_size=1, flush_interval=0.0005, queue_size=1)
+            def emit():
+                for i in range(1000):
+                    sender.emit_many("example", [(0, {"message": "%d-%d" % (i, j)}) for j in range(5)])
+                sender.close()
+            thread=threading.Thread(target=emit)
+            thread.daemon=True
+            thread.start()
+            thread.join(30)
+            self.assertFalse(thread.is_alive())
+            stub.stop()
+            self.assertEqual(["%d-%d" % (i, j) for i in range(1000) for j in range(5)], [record["message"] for tag, record in stub.events])
+
+    def test_file_index_matches_glob(self):
+        for folder in ["a", "b", ".hidden"]:
+            os.makedirs(os.path.join(self.input_dir, folder))
+            create_files(os.path.join(self.input_dir, folder), 3)
+            open(os.path.join(self.input_dir, folder, ".app.log"), "w").close()
+        index=collector.FileIndex()
+        for pattern in ["*/*.log", "*/.*.log", ".*/app-[01].log", "a/app-?.log", "b/app-2.log", "b/missing.log", "*/"]:
+            pattern=os.path.join(self.input_dir, pattern)
+            self.assertEqual(sorted(glob.glob(pattern)), sorted(index.glob(pattern)))
+
+    def test_copy_file_ranges_and_links(self):
+        source=os.path.join(self.input_dir, "source.log")
+        with open(source, "wb") as f:
+            f.write(b"0123456789" * 1000)
+        stat=os.stat(source)
+        for start, end, mmap_threshold in [(0, None, 1), (10, 25, 1), (5, 9000, 100000)]:
+            dest=os.path.join(self.output_dir, "dest.log")
+            collector.copy_file(source, dest, stat, start, end, mmap_threshold=mmap_threshold)
+            with open(source, "rb") as f, open(dest, "rb") as d:
+                self.assertEqual(f.read()[start:end], d.read())
+        self.assertEqual("link", collector.copy_file(source, os.path.join(self.output_dir, "link.log"), stat, link=True))
+        self.assertEqual(os.stat(source).st_ino, os.stat(os.path.join(self.output_dir, "link.log")).st_ino)
+
+    def test_link_files_keeps_sources_with_folder_script(self):
+        create_files(self.input_dir, 1)
+        with open(os.path.join(self.input_dir, "app-0.log")) as f:
+            original=f.read()
+        script=os.path.join(self.work_dir, "folder.sh")
+        with open(script, "w") as f:
+            f.write("#!/bin/sh\nfind \"$1\" -type f -exec sh -c 'echo tampered >> \"$0\"' {} \\;\n")
+        os.chmod(script, 0o755)
+        run_collector(self.work_dir, self.collector_config(rules=[], linkFiles=True, processFilesFolderScript=script))
+        with open(os.path.join(self.input_dir, "app-0.log")) as f:
+            self.assertEqual(original, f.read())
+        self.assertEqual(original + "tampered\n", read_collected_files(self.output_dir)["app-0.log"])
+
+    def test_parallel_compression(self):
+        data=os.urandom(1000).hex().encode() * 50
+        output=os.path.join(self.output_dir, "chunks.gz")
+        writer=collector.ParallelCompressWriter(open(output, "wb"), gzip.compress, 3, chunk_size=1000)
+        for i in range(0, len(data), 777):
+            writer.write(data[i:i + 777])
+        writer.close()
+        with gzip.open(output) as f:
+            self.assertEqual(data, f.read())
+        create_files(self.input_dir, 3)
+        formats=[("gztar", "tar.gz"), ("bztar", "tar.bz2"), ("zip", "zip")]
+        try:
+            import zstandard
+            formats.append(("zstdtar", "tar.zst"))
+        except ImportError:
+            pass
+        for compressFormat, extension in formats:
+            destination=os.path.join(self.output_dir, compressFormat)
+            collector.make_archive(self.input_dir, destination, compressFormat, extension, level=1, threads=2)
+            archive_file="%s.%s" % (destination, extension)
+            if compressFormat == "zip":
+                with zipfile.ZipFile(archive_file) as archive:
+                    self.assertEqual(archive.read("input/app-1.log"), open(os.path.join(self.input_dir, "app-1.log"), "rb").read())
+                continue
+            if compressFormat == "zstdtar":
+                with open(archive_file, "rb") as f:
+                    archive=tarfile.open(fileobj=io.BytesIO(zstandard.ZstdDecompressor().stream_reader(f).read()))
+            else:
+                archive=tarfile.open(archive_file)
+            with archive:
+                self.assertEqual(archive.extractfile("input/app-1.log").read(), open(os.path.join(self.input_dir, "app-1.log"), "rb").read())
+        content=b"".join(b"line %d value %d\n" % (i, (i * 7919) % 1000) for i in range(20000))
+        sizes=[]
+        for level in [1, 9]:
+            writer=collector.open_archive(os.path.join(self.output_dir, "level-%d" % level), "zip", "zip", level)
+            writer.add(os.path.join(self.input_dir, "app-1.log"), "app.log", io.BytesIO(content))
+            writer.close()
+            with zipfile.ZipFile(writer.path) as archive:
+                self.assertEqual(content, archive.read("app.log"))
+            sizes.append(os.path.getsize(writer.path))
+        self.assertLess(sizes[1], sizes[0])
+
+    def test_metrics_report(self):
+        create_files(self.input_dir, 3)
+        prometheus_file=os.path.join(self.work_dir, "filecollector.prom")
+        run_collector(self.work_dir, self.collector_config(compress=True, metrics={"prometheusFile": prometheus_file}))
+        reports=[name for name in os.listdir(self.output_dir) if name.endswith(".report.json")]
+        self.assertEqual(1, len(reports))
+        with open(os.path.join(self.output_dir, reports[0])) as f:
+            report=json.load(f)
+        self.assertEqual(3, report["counters"]["files"])
+        self.assertEqual(30, report["counters"]["lines"])
+        self.assertEqual(30, report["counters"]["substitutions"])
+        self.assertEqual(3, report["labels"]["app"]["files"])
+        for stage in ["discovery", "rules", "processFiles", "compression"]:
+            self.assertIn(stage, report["stages"])
+        with open(prometheus_file) as f:
+            metrics=f.read()
+        self.assertIn('filecollector_label_files{label="app"} 3', metrics)
+        self.assertIn('filecollector_failed_files 0', metrics)
+
+    def test_persistent_process_file_script(self):
+        create_files(self.input_dir, 6)
+        script=os.path.join(self.work_dir, "process_files.py")
+        records_file=os.path.join(self.work_dir, "records.txt")
+        with open(script, "w") as f:
+            f.write("#!%s\n" % sys.executable)
+            f.write("import json, os, sys\n")
+            f.write("for line in sys.stdin:\n")
+            f.write("    record=json.loads(line)\n")
+            f.write("    with open(%r, 'a') as out:\n" % records_file)
+            f.write("        out.write('%d %s %s\\n' % (os.getpid(), record['label'], os.path.basename(record['path'])))\n")
+            f.write("    status='failed' if record['path'].endswith('app-5.log') else 'ok'\n")
+            f.write("    print(json.dumps({'id': record['id'], 'status': status, 'error': 'bad file'}), flush=True)\n")
+        os.chmod(script, 0o755)
+        run_collector(self.work_dir, self.collector_config(processFileScript=script, processFileScriptMode="persistent",
+                                                           processFileScriptWorkers=2, workers=3))
+        with open(records_file) as f:
+            records=[line.split() for line in f.read().splitlines()]
+        self.assertEqual(6, len(records))
+        self.assertLessEqual(len(set(record[0] for record in records)), 2)
+        self.assertEqual(["app-%d.log" % i for i in range(6)], sorted(record[2] for record in records))
+        self.assertEqual({"app"}, set(record[1] for record in records))
+
+    def test_time_window_trimming(self):
+        log_file=os.path.join(self.input_dir, "app.log")
+        with open(log_file, "w") as f:
+            for i in range(1000):
+                f.write("2024-01-01 10:%02d:%02d line %d\n" % (i // 60, i % 60, i))
+                if i % 7 == 0:
+                    f.write("  continuation of %d\n" % i)
+        parser=collector.TimestampParser(r"^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d)", "%Y-%m-%d %H:%M:%S")
+        start_time=parser.parse(b"2024-01-01 10:05:00")
+        end_time=parser.parse(b"2024-01-01 10:06:00")
+        with open(log_file, "rb") as f:
+            lines=f.read().splitlines(True)
+        current=None
+        expected=[]
+        for line in lines:
+            current=parser.parse(line) or current
+            if start_time <= current <= end_time:
+                expected.append(line)
+        os.utime(log_file, (end_time, end_time))
+        files=[{"path": log_file, "label": "app", "useFullPath": False,
+                "timestampPattern": r"^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d)", "timestampFormat": "%Y-%m-%d %H:%M:%S"}]
+        config={"collector": self.collector_config(rules=[], files=files)}
+        collector.collect(config, [], start_time, end_time, logging.getLogger("filecollector"), hostname="test")
+        with open(glob.glob(os.path.join(self.output_dir, "tmp", "*", "app", "app.log"))[0], "rb") as f:
+            self.assertEqual(b"".join(expected), f.read())
+        self.assertEqual(61 + 9, len(expected))
+        self.assertEqual((0, 0), parser.find_range(log_file, os.path.getsize(log_file), end_time=parser.parse(b"2023-12-31 00:00:00")))
+        other_file=os.path.join(self.input_dir, "other.log")
+        with open(other_file, "w") as f:
+            f.write("no timestamp\n" * 10)
+        os.utime(other_file, (end_time, end_time))
+        self.assertIsNone(parser.find_range(other_file, os.path.getsize(other_file), start_time, end_time))
+        for window in [(start_time, None), (None, end_time), (start_time, end_time)]:
+            shutil.rmtree(os.path.join(self.output_dir, "tmp"))
+            files[0]["path"]=other_file
+            collector.collect(config, [], window[0], window[1], logging.getLogger("filecollector"), hostname="test")
+            with open(glob.glob(os.path.join(self.output_dir, "tmp", "*", "app", "other.log"))[0]) as f:
+                self.assertEqual("no timestamp\n" * 10, f.read())
+
+    def test_split_archive_volumes(self):
+        create_files(self.input_dir, 8, lines=200)
+        run_collector(self.work_dir, self.collector_config(compress=True))
+        expected=read_archive(self.output_dir)
+        upload_dir=os.path.join(self.work_dir, "uploads")
+        os.makedirs(upload_dir)
+        script=os.path.join(self.work_dir, "upload.sh")
+        with open(script, "w") as f:
+            f.write("#!/bin/sh\ncp \"$1\" %s/\n" % upload_dir)
+        os.chmod(script, 0o755)
+        for streamArchive in [False, True]:
+            shutil.rmtree(self.output_dir)
+            os.makedirs(self.output_dir)
+            run_collector(self.work_dir, self.collector_config(compress=True, maxArchiveSize=512, streamArchive=streamArchive,
+                                                               deleteProcessedTempFiles=True, outputScript=script, deleteCompressedFile=True))
+            self.assertEqual([], os.listdir(self.output_dir))
+            manifests=glob.glob(os.path.join(upload_dir, "*.manifest.json"))
+            self.assertEqual(1, len(manifests))
+            with open(manifests[0]) as f:
+                manifest=json.load(f)
+            self.assertGreater(len(manifest["volumes"]), 1)
+            self.assertEqual(8, sum(len(volume["files"]) for volume in manifest["volumes"]))
+            self.assertEqual(sorted(volume["name"] for volume in manifest["volumes"]), sorted(name for name in os.listdir(upload_dir) if name.endswith(".zip")))
+            os.remove(manifests[0])
+            self.assertEqual(expected, read_archive(upload_dir))
+            shutil.rmtree(upload_dir)
+            os.makedirs(upload_dir)
+
+    def test_dedup_cache(self):
+        create_files(self.input_dir, 3)
+        cache_dir=os.path.join(self.work_dir, "cache")
+        def collect(mode, **kwargs):
+            shutil.rmtree(os.path.join(self.output_dir, "tmp"), ignore_errors=True)
+            run_collector(self.work_dir, self.collector_config(dedup={"mode": mode, "cacheFolder": cache_dir}, **kwargs))
+            return read_collected_files(self.output_dir)
+        first=collect("reuse")
+        with open(os.path.join(cache_dir, "index.json")) as f:
+            entries=json.load(f)["entries"]
+        self.assertEqual(3, len(entries))
+        digest=[entry["digest"] for key, entry in entries.items() if key.startswith(os.path.join(self.input_dir, "app-0.log"))][0]
+        with open(os.path.join(cache_dir, "objects", digest), "a") as f:
+            f.write("from cache\n")
+        with open(os.path.join(self.input_dir, "app-1.log"), "a") as f:
+            f.write("new line\n")
+        second=collect("reuse")
+        cached_file=glob.glob(os.path.join(self.output_dir, "tmp", "*", "app", "**", "app-0.log"), recursive=True)[0]
+        self.assertNotEqual(os.stat(cached_file).st_ino, os.stat(os.path.join(cache_dir, "objects", digest)).st_ino)
+        self.assertEqual(first["app-0.log"] + "from cache\n", second["app-0.log"])
+        self.assertEqual(first["app-1.log"] + "new line\n", second["app-1.log"])
+        self.assertEqual(first["app-2.log"], second["app-2.log"])
+        self.assertEqual(dict(first, **{"app-1.log": second["app-1.log"]}), collect("reuse", rules=[{"pattern": "card", "replacement": "card"}] + self.collector_config()["rules"]))
+        shutil.rmtree(cache_dir)
+        collect("reference", streamArchive=True, compress=True, deleteProcessedTempFiles=True)
+        for name in os.listdir(self.output_dir):
+            os.remove(os.path.join(self.output_dir, name))
+        with open(os.path.join(self.input_dir, "app-2.log"), "a") as f:
+            f.write("new line\n")
+        third=collect("reference")
+        self.assertEqual(["app-2.log", "dedup.json"], sorted(third))
+        manifest=json.loads(third["dedup.json"])
+        self.assertEqual(["app-0.log", "app-1.log"], [os.path.basename(entry["path"]) for entry in manifest["files"]])
+        self.assertTrue(all(entry["path"].startswith("app" + os.sep) and entry["bundle"] != manifest["bundle"] for entry in manifest["files"]))
+
+    def test_line_filter(self):
+        levels=["ERROR", "WARN", "INFO", "DEBUG"]
+        data="".join("2024-01-01 %s line %d%s\n" % (levels[i % 4], i, " timeout" if i % 3 == 0 else "") for i in range(200)).encode()
+        for include, exclude in [(["ERROR", "WARN"], None), (["ERROR", r"line 1\d\b"], None), (None, ["DEBUG"]),
+                                 (None, ["DEBUG", r"line \d+ timeout"]), ("WARN", ["timeout"]), (["WARN", "ERR(OR)"], ["timeout", r"line 4\d"])]:
+            includes=[include] if isinstance(include, str) else include
+            def expected(content):
+                return b"".join(line for line in content.splitlines(True)
+                                if (not includes or any(re.search(pattern.encode(), line) for pattern in includes))
+                                and not any(re.search(pattern.encode(), line) for pattern in exclude or []))
+            line_filter=collector.LineFilter(include, exclude)
+            self.assertEqual(expected(data), line_filter.filter(data))
+            self.assertEqual(expected(data + b"last ERROR WARN line"), line_filter.filter(data + b"last ERROR WARN line"))
+        with open(os.path.join(self.input_dir, "app.log"), "wb") as f:
+            f.write(data)
+        files=[{"path": os.path.join(self.input_dir, "*.log"), "label": "app", "includeLines": ["ERROR"], "excludeLines": ["timeout"]}]
+        for streamArchive in [False, True]:
+            shutil.rmtree(self.output_dir)
+            os.makedirs(self.output_dir)
+            run_collector(self.work_dir, self.collector_config(files=files, compress=True, streamArchive=streamArchive))
+            content=list(read_archive(self.output_dir).values())[0]
+            self.assertEqual(33, len(content.splitlines()))
+            self.assertTrue(all("ERROR" in line and "timeout" not in line for line in content.splitlines()))
+
+    def test_config_cache(self):
+        config_file=os.path.join(self.work_dir, "filecollector.yaml")
+        cache_file=os.path.join(self.work_dir, ".filecollector.yaml.cache.json")
+        with open(config_file, "w") as f:
+            yaml.dump({"collector": self.collector_config(workers="2", compress="", hostname="myhost")}, f)
+        config=collector.load_config(config_file)
+        self.assertEqual(2, config.config["collector"]["workers"])
+        self.assertIs(False, config.config["collector"]["compress"])
+        self.assertEqual("myhost", config.hostname)
+        self.assertEqual("[REDACTED]", config.rule_engine.apply("1234-5678-9012-3456"))
+        with open(cache_file) as f:
+            cache=json.load(f)
+        cache["config"]["collector"]["workers"]=3
+        with open(cache_file, "w") as f:
+            json.dump(cache, f)
+        self.assertEqual(3, collector.load_config(config_file).config["collector"]["workers"])
+        self.assertEqual(2, collector.load_config(config_file, use_cache=False).config["collector"]["workers"])
+        with open(config_file, "w") as f:
+            yaml.dump({"collector": self.collector_config(workers=4, hostname="myhost")}, f)
+        self.assertEqual(4, collector.load_config(config_file).config["collector"]["workers"])
+        with open(config_file, "a") as f:
+            f.write("updated: 2020-06-25\n")
+        self.assertEqual(4, collector.load_config(config_file).config["collector"]["workers"])
+        self.assertNotIn("updated", collector.load_config(config_file).config)
+        with open(config_file, "w") as f:
+            yaml.dump({"collector": self.collector_config(workers=5, hostname="myhost", lastReview=datetime.date(2020, 6, 25))}, f)
+        self.assertEqual(5, collector.load_config(config_file).config["collector"]["workers"])
+        self.assertEqual([".filecollector.yaml.cache.json", "filecollector.yaml", "input", "output"], sorted(os.listdir(self.work_dir)))
+        for invalid in [{"workers": "many"}, {"compressFormat": "rar"}, {"rules": [{"pattern": "(", "replacement": ""}]},
+                        {"files": [{"path": "/var/log/*.log"}]}]:
+            with open(config_file, "w") as f:
+                yaml.dump({"collector": self.collector_config(**invalid)}, f)
+            self.assertRaises(ValueError, collector.load_config, config_file)
+
+    def test_daemon_collects_changed_files(self):
+        log_file=os.path.join(self.input_dir, "app.log")
+        with open(log_file, "w") as f:
+            f.write("before start\n")
+        config={"collector": self.collector_config(rules=[], useFullPath=False, files=[{"path": os.path.join(self.input_dir, "*.log"), "label": "app"}])}
+        daemon=collector.CollectorDaemon(config, [], logging.getLogger("filecollector"), collector.PollingWatcher(0.05), bundleInterval=0.1)
+        thread=threading.Thread(target=daemon.run)
+        thread.start()
+        try:
+            def wait_for_bundles(count):
+                deadline=time.time() + 10
+                while time.time() < deadline:
+                    bundles=sorted(os.path.basename(os.path.dirname(os.path.dirname(path))) for path in glob.glob(os.path.join(self.output_dir, "tmp", "*", "app", "app.log")) if os.path.getsize(path))
+                    if len(bundles) >= count:
+                        return bundles
+                    time.sleep(0.05)
+                self.fail("no bundle was collected")
+            bundles=wait_for_bundles(1)
+            with open(log_file, "a") as f:
+                f.write("after start\n")
+            bundles=wait_for_bundles(2)
+            with open(os.path.join(self.output_dir, "tmp", bundles[0], "app", "app.log")) as f:
+                self.assertEqual("before start\n", f.read())
+            with open(os.path.join(self.output_dir, "tmp", bundles[1], "app", "app.log")) as f:
+                self.assertEqual("after start\n", f.read())
+        finally:
+            daemon.stop()
+            thread.join()
+
+    def test_daemon_keeps_state_of_unchanged_files(self):
+        for name in ["a.log", "b.log"]:
+            with open(os.path.join(self.input_dir, name), "w") as f:
+                f.write("%s before start\n" % name)
+        cache_dir=os.path.join(self.work_dir, "cache")
+        config={"collector": self.collector_config(rules=[], useFullPath=False, dedup={"cacheFolder": cache_dir})}
+        daemon=collector.CollectorDaemon(config, [], logging.getLogger("filecollector"), collector.PollingWatcher(0.05), bundleInterval=0.1)
+        thread=threading.Thread(target=daemon.run)
+        thread.start()
+        def wait_for(condition):
+            deadline=time.time() + 10
+            while time.time() < deadline:
+                result=condition()
+                if result:
+                    return result
+                time.sleep(0.05)
+            self.fail("timed out")
+        def collected(name, content):
+            for path in glob.glob(os.path.join(self.output_dir, "tmp", "*", "app", name)):
+                with open(path) as f:
+                    if f.read() == content:
+                        return True
+            return False
+        def dedup_entries():
+            with open(os.path.join(cache_dir, "index.json")) as f:
+                return len(json.load(f)["entries"])
+        try:
+            wait_for(lambda: collected("b.log", "b.log before start\n"))
+            with open(os.path.join(self.input_dir, "a.log"), "a") as f:
+                f.write("a.log after start\n")
+            wait_for(lambda: collected("a.log", "a.log after start\n"))
+            wait_for(lambda: len(glob.glob(os.path.join(self.output_dir, "tmp", "*"))) == 2 and dedup_entries() == 2)
+            with open(os.path.join(self.input_dir, "b.log"), "a") as f:
+                f.write("b.log after start\n")
+            wait_for(lambda: collected("b.log", "b.log after start\n"))
+        finally:
+            daemon.stop()
+            thread.join()
+        with open(os.path.join(self.output_dir, ".filecollector-state.json")) as f:
+            self.assertEqual(2, len(json.load(f)))
+        self.assertEqual(2, dedup_entries())
+
+    def test_daemon_ignores_files_that_are_not_collected(self):
+        log_file=os.path.join(self.input_dir, "app.log")
+        with open(log_file, "w") as f:
+            f.write("before start\n")
+        files=[{"path": os.path.join(self.input_dir, "*.log"), "label": "app", "excludes": [os.path.join(self.input_dir, "debug.log")]}]
+        config={"collector": self.collector_config(rules=[], useFullPath=False, compress=True, incremental=True, files=files)}
+        daemon=collector.CollectorDaemon(config, [], logging.getLogger("filecollector"), collector.PollingWatcher(0.05), bundleInterval=0.1)
+        thread=threading.Thread(target=daemon.run)
+        thread.start()
+        def bundles():
+            return sorted(glob.glob(os.path.join(self.output_dir, "*.zip")))
+        def wait_for_bundles(count):
+            deadline=time.time() + 10
+            while time.time() < deadline and len(bundles()) < count:
+                time.sleep(0.05)
+            return bundles()
+        try:
+            self.assertEqual(1, len(wait_for_bundles(1)))
+            for name in ["unrelated.txt", "debug.log", "unrelated.txt"]:
+                with open(os.path.join(self.input_dir, name), "a") as f:
+                    f.write("not collected\n")
+                time.sleep(0.3)
+            self.assertEqual(1, len(bundles()))
+            with open(log_file, "a") as f:
+                f.write("after start\n")
+            self.assertEqual(2, len(wait_for_bundles(2)))
+        finally:
+            daemon.stop()
+            thread.join()
+        with zipfile.ZipFile(bundles()[1]) as archive:
+            self.assertEqual(["after start\n"], [archive.read(name).decode() for name in archive.namelist() if not name.endswith("/")])
+        collector.collect(config, [], None, None, logging.getLogger("filecollector"), hostname="test", paths=[log_file])
+        self.assertEqual(2, len(bundles()))
+
 
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()
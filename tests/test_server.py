@@ -1,10 +1,17 @@
 import unittest
 import os
+import json
+import shutil
+import io
+import tarfile
+import tempfile
+import threading
+import http.client
 from filecollector import server
 try:
-    from unittest.mock import MagicMock
+    from unittest.mock import MagicMock, patch
 except ImportError as error:
-    from mock import MagicMock
+    from mock import MagicMock, patch
 
 script_dir=os.path.dirname(os.path.abspath(__file__))
 
@@ -17,5 +24,93 @@ class TestCollector(unittest.TestCase):
         except Exception: 
             self.assertTrue(True)
 
+    def test_range_conditional_and_index_requests(self):
+        folder=tempfile.mkdtemp()
+        try:
+            with open(os.path.join(folder, "bundle.zip"), "wb") as f:
+                f.write(bytes(range(256)) * 4)
+            httpd=server.create_server(0, folder, host="127.0.0.1")
+            thread=threading.Thread(target=httpd.serve_forever)
+            thread.start()
+            try:
+                connection=http.client.HTTPConnection("127.0.0.1", httpd.server_address[1])
+                connection.request("GET", "/bundle.zip")
+                response=connection.getresponse()
+                self.assertEqual(200, response.status)
+                self.assertEqual(1024, len(response.read()))
+                etag=response.getheader("ETag")
+                connection.request("GET", "/bundle.zip", headers={"Range": "bytes=1000-"})
+                response=connection.getresponse()
+                self.assertEqual(206, response.status)
+                self.assertEqual("bytes 1000-1023/1024", response.getheader("Content-Range"))
+                self.assertEqual(bytes(range(232, 256)), response.read())
+                connection.request("GET", "/bundle.zip", headers={"Range": "bytes=2000-"})
+                response=connection.getresponse()
+                response.read()
+                self.assertEqual(416, response.status)
+                connection.request("GET", "/bundle.zip", headers={"If-None-Match": etag})
+                response=connection.getresponse()
+                response.read()
+                self.assertEqual(304, response.status)
+                connection.request("GET", "/index.json")
+                response=connection.getresponse()
+                index=json.loads(response.read().decode())
+                self.assertEqual([("bundle.zip", 1024, etag)], [(bundle["name"], bundle["size"], bundle["etag"]) for bundle in index["bundles"]])
+                connection.close()
+            finally:
+                httpd.shutdown()
+                httpd.server_close()
+                thread.join()
+        finally:
+            shutil.rmtree(folder)
+
+    def test_stream_endpoint(self):
+        folder=tempfile.mkdtemp()
+        try:
+            input_dir=os.path.join(folder, "input")
+            os.makedirs(input_dir)
+            for name in ["app.log", "other.log"]:
+                with open(os.path.join(input_dir, name), "w") as f:
+                    for i in range(100):
+                        f.write("%s line %d %s card: 1234-5678-9012-3456\n" % (name, i, "ERROR" if i % 10 == 0 else "INFO"))
+            config={"collector": {"files": [{"path": os.path.join(input_dir, "app.log"), "label": "app", "useFullPath": False},
+                                            {"path": os.path.join(input_dir, "other.log"), "label": "other", "useFullPath": False}],
+                                  "rules": [{"pattern": r"\d{4}-\d{4}-\d{4}-\d{4}", "replacement": "[REDACTED]"}],
+                                  "hostname": "stream.example.com"}}
+            with patch("filecollector.collector.get_hostname") as get_hostname:
+                httpd=server.create_server(0, folder, host="127.0.0.1", collector_config=config)
+                get_hostname.assert_not_called()
+            thread=threading.Thread(target=httpd.serve_forever)
+            thread.start()
+            try:
+                connection=http.client.HTTPConnection("127.0.0.1", httpd.server_address[1])
+                connection.request("GET", "/stream?labels=app&grep=ERROR&format=ndjson")
+                response=connection.getresponse()
+                self.assertEqual(200, response.status)
+                self.assertEqual("chunked", response.getheader("Transfer-Encoding"))
+                records=[json.loads(line) for line in response.read().decode().splitlines()]
+                self.assertEqual(10, len(records))
+                self.assertEqual({"app"}, set(record["label"] for record in records))
+                self.assertEqual("app.log line 0 ERROR card: [REDACTED]", records[0]["line"])
+                connection.request("GET", "/stream?labels=app,other")
+                response=connection.getresponse()
+                with tarfile.open(fileobj=io.BytesIO(response.read()), mode="r:gz") as archive:
+                    names=archive.getnames()
+                    contents={os.path.basename(entry.name): archive.extractfile(entry).read().decode() for entry in archive.getmembers()}
+                self.assertTrue(all("-stream-example-com" in name.split("/", 1)[0] for name in names))
+                self.assertEqual(["app.log", "other.log"], sorted(contents))
+                self.assertEqual(100, contents["other.log"].count("[REDACTED]"))
+                connection.request("GET", "/stream?start=abc")
+                response=connection.getresponse()
+                response.read()
+                self.assertEqual(400, response.status)
+                connection.close()
+            finally:
+                httpd.shutdown()
+                httpd.server_close()
+                thread.join()
+        finally:
+            shutil.rmtree(folder)
+
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()